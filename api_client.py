@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import aiohttp
+from urllib.parse import urlencode
+from constants import *
+import instrumentation
+
+
+class ApiQuotaExceeded(Exception):
+    pass
+
+
+class ApiResponseError(Exception):
+    pass
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+    # Stores raw API responses on disk under the hash of the endpoint and the query.
+    # In offline mode responses are served only from the cache and missing ones raise CacheMiss.
+
+    def __init__(self, directory: str = API_CACHE_DIR, offline: bool = False):
+        self.directory = directory
+        self.offline = offline
+        self.hits = 0
+
+    @staticmethod
+    def get_key(endpoint: str, params: dict) -> str:
+        query = urlencode(sorted((key, str(value)) for key, value in params.items()))
+        return hashlib.sha256(f"{endpoint}?{query}".encode()).hexdigest()
+
+    @staticmethod
+    def get_ttl(endpoint: str, params: dict) -> float or None:
+        # odds and games of the current season can still change, finished seasons can not
+        if endpoint == "odds":
+            return API_CACHE_ODDS_TTL
+        if int(params.get("season", LAST_SEASON)) >= LAST_SEASON:
+            return API_CACHE_CURRENT_SEASON_TTL
+        return None
+
+    def get_path(self, endpoint: str, params: dict) -> str:
+        return os.path.join(self.directory, endpoint, f"{self.get_key(endpoint, params)}.json")
+
+    def get(self, endpoint: str, params: dict) -> bytes or None:
+        path = self.get_path(endpoint, params)
+        if not os.path.exists(path):
+            if self.offline:
+                raise CacheMiss(f"{endpoint} {params} is not in the cache")
+            return None
+
+        ttl = self.get_ttl(endpoint, params)
+        if not self.offline and ttl is not None and time.time() - os.path.getmtime(path) > ttl:
+            return None
+
+        self.hits += 1
+        instrumentation.count("api.cache_hits")
+        with open(path, "rb") as file:
+            return file.read()
+
+    def put(self, endpoint: str, params: dict, body: bytes):
+        path = self.get_path(endpoint, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # writing to a temporary file first so that an interrupted run never leaves a broken response in the cache
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(body)
+        os.replace(f"{path}.tmp", path)
+
+
+class TokenBucket:
+    # allows 'rate' calls per minute with bursts of at most 'capacity' calls
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # the lock makes waiting calls take tokens in the order they came
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                # time spent here is time lost to the limits of our API plan
+                with instrumentation.timer("api.rate_limit_wait"):
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def drain(self):
+        # API told us that there are no calls left in the current minute,
+        # so the next call has to wait for a whole token to be refilled
+        self.refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class ApiClient:
+    # Asynchronous client for API-Football that reuses connections from one pool,
+    # spaces calls out with a token bucket sized to our API plan and retries failed calls with backoff.
+    # Responses are looked up in the cache first, so they don't use up the API quota.
+
+    def __init__(self, calls_per_minute: float = API_CALLS_PER_MINUTE, burst: int = API_BURST,
+                 max_connections: int = API_MAX_CONNECTIONS, cache: ResponseCache or None = None):
+        self.cache = cache
+        self.bucket = TokenBucket(calls_per_minute, burst)
+        self.max_connections = max_connections
+        self.session = None
+        self.api_calls = 0
+        self.quota_exhausted = False
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            headers=HEADERS, connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def check_rate_limit_headers(self, headers):
+        # x-ratelimit-requests-remaining is the daily quota, X-RateLimit-Remaining is the quota of the current minute.
+        # The daily quota runs out with the call that returned these headers, its response is still used.
+        if headers.get("x-ratelimit-requests-remaining") == "0":
+            self.quota_exhausted = True
+        if headers.get("X-RateLimit-Remaining") == "0":
+            self.bucket.drain()
+
+    async def fetch(self, endpoint: str, params: dict) -> bytes:
+        if self.cache is not None:
+            body = self.cache.get(endpoint, params)
+            if body is not None:
+                return body
+
+        body = await self.fetch_from_api(endpoint, params)
+        if self.cache is not None:
+            self.cache.put(endpoint, params, body)
+
+        return body
+
+    async def fetch_from_api(self, endpoint: str, params: dict) -> bytes:
+        for attempt in range(API_MAX_RETRIES + 1):
+            if self.quota_exhausted:
+                raise ApiQuotaExceeded("daily API quota is exhausted")
+            await self.bucket.acquire()
+            try:
+                async with self.session.get(f"{BASE_URL}/{endpoint}", params=params) as response:
+                    self.api_calls += 1
+                    instrumentation.count("api.calls")
+                    self.check_rate_limit_headers(response.headers)
+                    # too many requests and server errors are worth retrying, other errors are not
+                    if response.status != 429 and response.status < 500:
+                        response.raise_for_status()
+                        body = await response.read()
+                        # API-Football reports quota and rate limit errors with a 2xx status, an empty response
+                        # and a non-empty errors field, such a body is retried and never returned to be cached
+                        errors = json.loads(body).get("errors")
+                        if not errors:
+                            return body
+                        if "rateLimit" in errors:
+                            self.bucket.drain()
+                        if "requests" in errors:
+                            self.quota_exhausted = True
+                        error = ApiResponseError(f"{endpoint} {params}: {errors}")
+                    else:
+                        if response.status == 429:
+                            self.bucket.drain()
+                        error = aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status,
+                            message=response.reason)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exception:
+                error = exception
+
+            if attempt < API_MAX_RETRIES:
+                instrumentation.count("api.retries")
+                await asyncio.sleep(API_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+        raise error
+
+    async def get(self, endpoint: str, params: dict) -> dict:
+        return json.loads(await self.fetch(endpoint, params))
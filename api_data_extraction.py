@@ -1,15 +1,15 @@
-import requests
+import argparse
+import asyncio
+import io
+import ijson
 import pandas as pd
-import json
-import time
+import numpy as np
+from array import array
 from datetime import datetime
+from api_client import ApiClient, ResponseCache
 from constants import *
-
-
-def days_from_to(from_date: str, to_date: str) -> int:
-	from_date = datetime.strptime(from_date, "%Y-%m-%d")
-	to_date = datetime.strptime(to_date, "%Y-%m-%d")
-	return (to_date - from_date).days
+import instrumentation
+from storage import save_games
 
 
 def get_winner(game: dict) -> int:
@@ -21,115 +21,166 @@ def get_winner(game: dict) -> int:
 		return 0
 
 
-def all_league_season_games(league_id: int, season: int) -> pd.DataFrame:
-	# API call
-	url = f"{BASE_URL}/fixtures?league={league_id}&season={season}"
-	response = requests.request("GET", url, headers=HEADERS, data={})
-	parsed = json.loads(response.text)
-
-	# creating and filling in the DataFrame
-	df = pd.DataFrame(columns=[
-		"game_id", "home_team_id", "away_team_id", "goal_difference", "result", "date", "league_id", "season"])
-	for game in parsed["response"]:
+def stream_items(body: bytes, prefix: str):
+	# decoding one item at a time instead of the whole response
+	return ijson.items(io.BytesIO(body), prefix, use_float=True)
+
+
+def get_page_count(body: bytes) -> int:
+	# paging comes before the response in API documents, so we stop reading right after it
+	return next(stream_items(body, "paging.total"))
+
+
+@instrumentation.timed("api.parse_league_season_games")
+def parse_league_season_games(body: bytes, league_id: int, season: int) -> pd.DataFrame:
+	# filling in typed column buffers and creating the DataFrame once all games are read
+	game_ids, home_team_ids, away_team_ids = array("i"), array("i"), array("i")
+	goal_differences, results, dates = array("i"), array("b"), []
+	for game in stream_items(body, "response.item"):
 		if game["fixture"]["status"]["long"] == "Match Finished":
-			df.loc[df.shape[0]] = pd.Series({
-				"game_id": game["fixture"]["id"],
-				"home_team_id": game["teams"]["home"]["id"],
-				"away_team_id": game["teams"]["away"]["id"],
-				"goal_difference": game["goals"]["home"] - game["goals"]["away"],
-				"result": get_winner(game),
-				"date": game["fixture"]["date"][:10:],
-				"league_id": league_id,
-				"season": season
-			})
-
-	return df
-
-
-def get_odds_df(league_id: int, api_calls: int) -> pd.DataFrame:
-	odds_df_list = []
-	page_number = 1
-	# we are iterating through all pages of games with odds
-	while True:
-		# API call
-		url = f"{BASE_URL}/odds?league={league_id}&season={LAST_SEASON}&bookmaker={BOOKMAKER}&bet=1&page={page_number}"
-		response = requests.request("GET", url, headers=HEADERS, data={})
-		parsed = json.loads(response.text)
-		api_calls = check_api_call_limit(api_calls)
-
-		# creating and filling in the DataFrame
-		odds_df = pd.DataFrame(columns=["game_id", "home_odd", "draw_odd", "away_odd"])
-		for game in parsed["response"]:
-			# making sure we get only finished games
-			if days_from_to(datetime.now().strftime("%Y-%m-%d"), game["fixture"]["date"][:10:]) < 0:
-				# sometimes API does not have full information (e.g. away_odd missing)
-				# this block catches it
-				try:
-					odds_df.loc[odds_df.shape[0]] = pd.Series({
-						"game_id": game["fixture"]["id"],
-						"home_odd": game["bookmakers"][0]["bets"][0]["values"][0]["odd"],
-						"draw_odd": game["bookmakers"][0]["bets"][0]["values"][1]["odd"],
-						"away_odd": game["bookmakers"][0]["bets"][0]["values"][2]["odd"],
-					})
-				except IndexError:
-					continue
-
-		odds_df_list.append(odds_df)
-		if page_number == parsed["paging"]["total"]:
-			break
-		else:
-			page_number += 1
-
-	if len(odds_df_list) != 0:
-		return pd.concat(odds_df_list, ignore_index=True, sort=False)
-	else:
-		return pd.DataFrame(columns=["game_id", "home_odd", "draw_odd", "away_odd"])
+			game_ids.append(game["fixture"]["id"])
+			home_team_ids.append(game["teams"]["home"]["id"])
+			away_team_ids.append(game["teams"]["away"]["id"])
+			goal_differences.append(game["goals"]["home"] - game["goals"]["away"])
+			results.append(get_winner(game))
+			dates.append(game["fixture"]["date"][:10:])
+
+	return pd.DataFrame({
+		"game_id": np.asarray(game_ids),
+		"home_team_id": np.asarray(home_team_ids),
+		"away_team_id": np.asarray(away_team_ids),
+		"goal_difference": np.asarray(goal_differences),
+		"result": np.asarray(results),
+		"date": np.array(dates, dtype="datetime64[D]"),
+		"league_id": np.full(len(game_ids), league_id, dtype=np.int32),
+		"season": np.full(len(game_ids), season, dtype=np.int32)
+	})
+
+
+@instrumentation.timed("api.all_league_season_games")
+async def all_league_season_games(client: ApiClient, league_id: int, season: int) -> pd.DataFrame:
+	# API call
+	body = await client.fetch("fixtures", {"league": league_id, "season": season})
+
+	return parse_league_season_games(body, league_id, season)
+
+
+def parse_odds(body: bytes) -> pd.DataFrame:
+	# filling in typed column buffers and creating the DataFrame once all games are read
+	game_ids, home_odds, draw_odds, away_odds = array("i"), array("d"), array("d"), array("d")
+	today = datetime.now().strftime("%Y-%m-%d")
+	for game in stream_items(body, "response.item"):
+		# making sure we get only finished games
+		if game["fixture"]["date"][:10:] < today:
+			# sometimes API does not have full information (e.g. away_odd missing)
+			# this block catches it
+			try:
+				values = game["bookmakers"][0]["bets"][0]["values"]
+				game_odds = float(values[0]["odd"]), float(values[1]["odd"]), float(values[2]["odd"])
+			except IndexError:
+				continue
+			game_ids.append(game["fixture"]["id"])
+			home_odds.append(game_odds[0])
+			draw_odds.append(game_odds[1])
+			away_odds.append(game_odds[2])
 
+	return pd.DataFrame({
+		"game_id": np.asarray(game_ids),
+		"home_odd": np.asarray(home_odds),
+		"draw_odd": np.asarray(draw_odds),
+		"away_odd": np.asarray(away_odds)
+	})
 
-def check_api_call_limit(api_calls):
-	# API has restriction on amount of requests (10 per minute)
-	# so we call time.sleep(61) every 10 calls
-	api_calls += 1
-	if api_calls == 10:
-		time.sleep(61)
-		return 0
-	else:
-		return api_calls
 
+async def get_odds_page(client: ApiClient, params: dict, page_number: int) -> pd.DataFrame:
+	# every page is parsed as soon as it arrives, so only the columns of parsed pages are kept in memory
+	return parse_odds(await client.fetch("odds", {**params, "page": page_number}))
 
-def main():
+
+@instrumentation.timed("api.get_odds_df")
+async def get_odds_df(client: ApiClient, league_id: int) -> pd.DataFrame:
+	params = {"league": league_id, "season": LAST_SEASON, "bookmaker": BOOKMAKER, "bet": 1}
+
+	# the first page tells us how many pages there are, the rest of them are requested at the same time
+	first_page = await client.fetch("odds", {**params, "page": 1})
+	odds_df_list = [parse_odds(first_page)] + await asyncio.gather(*[
+		get_odds_page(client, params, page_number) for page_number in range(2, get_page_count(first_page) + 1)])
+
+	return pd.concat(odds_df_list, ignore_index=True, sort=False)
+
+
+async def get_evaluation_games(client: ApiClient, league_id: int):
+	# API stores odds only for one week, therefore we are looking for the games with odds only in last season
+	last_season_games, odds_df = await asyncio.gather(
+		all_league_season_games(client, league_id, LAST_SEASON), get_odds_df(client, league_id))
+
+	return last_season_games, pd.merge(last_season_games, odds_df, on="game_id")
+
+
+async def extract_all_games(client: ApiClient):
 	data_frames = []
 	evaluation_dfs = []
+
+	# all requests are scheduled at once, the client keeps them within the limits of our API plan
+	evaluation_leagues = [
+		league for league in LEAGUES1 + LEAGUES2 + LEAGUES3 if league not in EXTRA_EVALUATION_LEAGUES]
+	league_seasons = [
+		(league, season) for league in LEAGUES1 + LEAGUES2 + LEAGUES3 for season in range(FIRST_SEASON, LAST_SEASON+1)
+		if not (league in EXTRA_EVALUATION_LEAGUES and season != FIRST_SEASON)
+		and not (league in evaluation_leagues and season == LAST_SEASON)]
+
+	evaluation_results, season_results = await asyncio.gather(
+		asyncio.gather(*[get_evaluation_games(client, league) for league in evaluation_leagues]),
+		asyncio.gather(*[all_league_season_games(client, league, season) for league, season in league_seasons]))
+
+	# to avoid making the same request twice we reuse DataFrames for LAST_SEASON of evaluation leagues
 	dict_last_season_games = {}
-	api_calls = 0
+	for league, (last_season_games, evaluation_df) in zip(evaluation_leagues, evaluation_results):
+		evaluation_dfs.append(evaluation_df)
+		dict_last_season_games[league] = last_season_games
+	dict_season_games = dict(zip(league_seasons, season_results))
 
 	for league in LEAGUES1 + LEAGUES2 + LEAGUES3:
-		if league not in EXTRA_EVALUATION_LEAGUES:
-			# API stores odds only for one week, therefore we are looking for the games with odds only in last season
-			last_season_games = all_league_season_games(league, LAST_SEASON)
-			api_calls = check_api_call_limit(api_calls)
-			evaluation_dfs.append(pd.merge(last_season_games, get_odds_df(league, api_calls), on="game_id"))
-			# to avoid making the same request twice we store DataFrames for LAST_SEASON in a dictionary
-			dict_last_season_games[league] = last_season_games
-
 		for season in range(FIRST_SEASON, LAST_SEASON+1):
 			if league in EXTRA_EVALUATION_LEAGUES and season != FIRST_SEASON:
 				continue
-			if season == LAST_SEASON:
+			if season == LAST_SEASON and league in dict_last_season_games:
 				data_frames.append(dict_last_season_games[league])
 			else:
-				data_frames.append(all_league_season_games(league, season))
-				api_calls = check_api_call_limit(api_calls)
+				data_frames.append(dict_season_games[(league, season)])
 
-	# creating final DataFrames and save them in .pkl files
+	return data_frames, evaluation_dfs
+
+
+async def run_extraction(cache: ResponseCache):
+	async with ApiClient(cache=cache) as client:
+		games = await extract_all_games(client)
+		print(f"{client.api_calls} API calls, {cache.hits} responses from the cache")
+
+	return games
+
+
+def save_extracted_games(data_frames: list, evaluation_dfs: list):
+	# creating final DataFrames and save them as parquet datasets partitioned by league and season
 	if len(data_frames) != 0:
 		df = pd.concat(data_frames, ignore_index=True, sort=False)
 		if len(evaluation_dfs) != 0:
 			evaluation_df = pd.concat(evaluation_dfs, ignore_index=True, sort=False)
-			evaluation_df.to_pickle("data/evaluation.pkl")
+			save_games(evaluation_df, "evaluation")
 			# deleting evaluation games from games dataset
 			df = df.loc[df.index.difference(evaluation_df.index, sort=False)]
-		df.to_pickle("data/games.pkl")
+		save_games(df, "games")
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--offline", action="store_true", help="serve all API responses from the cache")
+	instrumentation.add_arguments(parser)
+	args = parser.parse_args()
+	instrumentation.setup(args)
+
+	data_frames, evaluation_dfs = asyncio.run(run_extraction(ResponseCache(offline=args.offline)))
+	save_extracted_games(data_frames, evaluation_dfs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import argparse
+import json
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+from constants import *
+import evaluation
+import instrumentation
+from evaluation import (MONEY, DEFAULT_GRID, get_parameter_combinations, get_stakes, get_backtest,
+                        get_evaluation_dataset, use_market_odds, share_arrays, init_grid_worker)
+from inference import load_model
+from odds_store import load_odds_store
+from staking import STRATEGIES, StakingStrategy
+from storage import save_results
+
+# paths simulated together, a chunk of paths times the grid fits in the CPU cache
+CHUNK_SIZE = 256
+RUIN_FRACTION = 0.1
+SIMULATION_METRIC_COLUMNS = [
+    "gain_mean", "gain_p5", "gain_p50", "gain_p95", "loss_probability", "risk_of_ruin", "max_drawdown_p50",
+    "max_drawdown_p95"]
+
+
+def get_bet_table(backtest: dict, strategy: StakingStrategy, combinations: np.array) -> tuple:
+    # stakes of every combination on every game that at least one of them bets on, and the return of one unit staked.
+    # The last row is a game without bets, paths that are shorter than the others are padded with it.
+    amounts, fractions, returns, _ = get_stakes(backtest, strategy, combinations)
+    games = np.flatnonzero((amounts > 0).any(axis=1) | (fractions > 0).any(axis=1))
+
+    tables = []
+    for table in (amounts, fractions, returns):
+        tables.append(np.concatenate((table[games], np.zeros((1,) + table.shape[1:]))))
+
+    return tuple(tables)
+
+
+def get_orders(rng: np.random.Generator, num_of_paths: int, num_of_games: int, num_of_all_games: int,
+               method: str) -> np.array:
+    # games without any bet don't change the bankroll, so only the games with bets are simulated
+    if method == "permute":
+        return rng.permuted(np.broadcast_to(np.arange(num_of_games), (num_of_paths, num_of_games)), axis=1)
+
+    # a bootstrap sample of the whole evaluation set contains Binomial(all games, share of games with bets) games
+    # with bets, those are drawn uniformly from the games with bets and the rest of the path is padded with no bets
+    num_of_bets = rng.binomial(num_of_all_games, num_of_games / max(num_of_all_games, 1), num_of_paths)
+    orders = rng.integers(0, num_of_games, (num_of_paths, num_of_bets.max(initial=0)))
+    orders[np.arange(orders.shape[1]) >= num_of_bets[:, None]] = num_of_games
+
+    return orders
+
+
+def simulate_paths(amounts: np.array, fractions: np.array, returns: np.array, orders: np.array,
+                   ruin_level: float) -> tuple:
+    # every step places one bet on all paths (rows) for all parameter combinations (columns) at once
+    money = np.full((orders.shape[0], amounts.shape[1]), MONEY, dtype=np.float64)
+    peak = money.copy()
+    lowest_ratio = np.ones_like(money)
+    ruined = np.zeros(money.shape, dtype=bool)
+    ratio = np.empty_like(money)
+    # strategies that stake only fixed amounts skip the multiplication with the bankroll
+    uses_fractions = fractions.any()
+
+    for games in orders.T:
+        stakes = amounts[games]
+        if uses_fractions:
+            stakes += fractions[games] * money
+        # like in evaluate, a bet bigger than the bankroll becomes 3/4 of the bankroll, ruined paths stop betting
+        np.copyto(stakes, money * 0.75, where=stakes > money)
+        np.copyto(stakes, 0, where=ruined)
+        stakes *= returns[games, None]
+        money += stakes
+
+        np.maximum(peak, money, out=peak)
+        np.divide(money, peak, out=ratio)
+        np.minimum(lowest_ratio, ratio, out=lowest_ratio)
+        ruined |= money < ruin_level
+
+    return money - MONEY, 1 - lowest_ratio, ruined
+
+
+def simulate_chunk(task: tuple) -> tuple:
+    # every chunk has its own generator, so results don't depend on the number of processes
+    chunk, num_of_paths, num_of_all_games, method, seed, ruin_level = task
+    amounts, fractions, returns = [evaluation.worker_arrays[name] for name in ["amounts", "fractions", "returns"]]
+    orders = get_orders(np.random.default_rng([seed, chunk]), num_of_paths, amounts.shape[0] - 1, num_of_all_games,
+                        method)
+
+    return simulate_paths(amounts, fractions, returns, orders, ruin_level)
+
+
+@instrumentation.timed("bankroll_simulation.simulate_grid")
+def simulate_grid(backtest: dict, grid: dict = DEFAULT_GRID, num_of_paths: int = 10000, method: str = "bootstrap",
+                  ruin_fraction: float = RUIN_FRACTION, processes: int = 1, seed: int = 0,
+                  strategy: str = "linear") -> pd.DataFrame:
+    strategy = STRATEGIES[strategy]
+    combinations = get_parameter_combinations(grid, strategy)
+    amounts, fractions, returns = get_bet_table(backtest, strategy, combinations)
+    num_of_all_games = backtest["result"].shape[0]
+    tasks = [(chunk, min(CHUNK_SIZE, num_of_paths - start), num_of_all_games, method, seed, MONEY * ruin_fraction)
+             for chunk, start in enumerate(range(0, num_of_paths, CHUNK_SIZE))]
+
+    # the bet table is shared with the workers like the backtest in the grid search
+    blocks, specs = share_arrays({"amounts": amounts, "fractions": fractions, "returns": returns})
+    try:
+        if processes == 1:
+            init_grid_worker(specs)
+            chunks = [simulate_chunk(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes or os.cpu_count(), initializer=init_grid_worker,
+                                      initargs=(specs,)) as pool:
+                chunks = pool.map(simulate_chunk, tasks)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    gains, drawdowns, ruined = [np.concatenate(arrays) for arrays in zip(*chunks)]
+
+    gain_percentiles = np.percentile(gains, [5, 50, 95], axis=0)
+    drawdown_percentiles = np.percentile(drawdowns, [50, 95], axis=0)
+    metrics = pd.DataFrame({
+        "gain_mean": gains.mean(axis=0), "gain_p5": gain_percentiles[0], "gain_p50": gain_percentiles[1],
+        "gain_p95": gain_percentiles[2], "loss_probability": (gains < 0).mean(axis=0),
+        "risk_of_ruin": ruined.mean(axis=0), "max_drawdown_p50": drawdown_percentiles[0],
+        "max_drawdown_p95": drawdown_percentiles[1]
+    }, columns=SIMULATION_METRIC_COLUMNS)
+    simulation_results = pd.concat([pd.DataFrame(combinations, columns=strategy.params), metrics], axis=1)
+    simulation_results.insert(0, "strategy", strategy.name)
+
+    return simulation_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", help="path to a json file with lists of values of the strategy parameters "
+                                       "to simulate, parameters that are not in the file use default values")
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=["linear"])
+    parser.add_argument("--paths", type=int, default=10000, help="number of simulated orders of games")
+    parser.add_argument("--method", choices=["bootstrap", "permute"], default="bootstrap",
+                        help="resample the evaluation games with replacement, or only shuffle their order")
+    parser.add_argument("--ruin", type=float, default=RUIN_FRACTION,
+                        help="share of the starting bankroll below which a path is ruined and stops betting")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes used for the simulation (0 - all cores)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--odds", choices=["dataset", "closing", "best"], default="dataset",
+                        help="bet at the odds of the dataset, the closing line of --bookmaker from the odds store, "
+                             "or the best closing price of all bookmakers")
+    parser.add_argument("--bookmaker", type=int, default=BOOKMAKER)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(args)
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as file:
+            grid = json.load(file)
+
+    backtest = get_backtest(load_model(), get_evaluation_dataset())
+    if args.odds != "dataset":
+        backtest = use_market_odds(backtest, load_odds_store(), args.odds, args.bookmaker)
+
+    simulation_results = pd.concat([simulate_grid(backtest, grid, args.paths, args.method, args.ruin, args.processes,
+                                                  args.seed, strategy) for strategy in args.strategies],
+                                   ignore_index=True)
+    save_results(simulation_results, "simulation_results")
+    print(simulation_results.sort_values("gain_p50", ascending=False).head(10).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
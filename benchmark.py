@@ -0,0 +1,238 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from constants import *
+from api_data_extraction import parse_league_season_games
+from bankroll_simulation import simulate_grid
+from db import DATABASE, GAMES_COLUMNS, COLUMN_TYPES, connect_to_db
+from evaluation import DEFAULT_GRID, run_grid_search
+from form_index import FormIndex
+from load_games_to_db import create_games_table, insert_into_games_table, bulk_load
+from staking import STRATEGIES
+from transform_data import build_features, get_labels, get_result_odds, get_odds
+import storage
+
+STAGES = ["parse", "bulk_load", "features", "training", "grid_search", "bankroll_simulation"]
+BOOKMAKER_MARGIN = 0.05
+
+
+def get_round_robin(teams: np.array) -> list:
+    # circle method: every team plays once per round, in the second half of the season home and away are swapped
+    teams = list(teams) + ([-1] if len(teams) % 2 else [])
+    rounds = []
+    for _ in range(len(teams) - 1):
+        rounds.append([(teams[i], teams[-1 - i]) for i in range(len(teams) // 2)
+                       if teams[i] != -1 and teams[-1 - i] != -1])
+        teams = [teams[0], teams[-1]] + teams[1:-1]
+
+    return rounds + [[(away, home) for home, away in games] for games in rounds]
+
+
+def generate_games(num_of_leagues: int, num_of_seasons: int, num_of_teams: int, seed: int = 0) -> pd.DataFrame:
+    # synthetic fixtures with the schema of the games and evaluation tables,
+    # goal differences and odds come from a hidden strength of every team, so the model has something to learn
+    rng = np.random.default_rng(seed)
+    columns = {column: [] for column in GAMES_COLUMNS + ["home_odd", "draw_odd", "away_odd"]}
+    for league in range(num_of_leagues):
+        league_id = league + 1
+        teams = np.arange(num_of_teams) + 1000 * league_id
+        strength = dict(zip(teams, rng.normal(0, 0.6, num_of_teams)))
+        for season in range(FIRST_SEASON, FIRST_SEASON + num_of_seasons):
+            season_start = np.datetime64(f"{season}-08-01")
+            for round_number, games in enumerate(get_round_robin(teams)):
+                home_team_ids, away_team_ids = np.array(games).T
+                expected = 0.3 + np.array([strength[home] - strength[away] for home, away in games])
+                goal_differences = np.rint(rng.normal(expected, 1.6)).astype(np.int32)
+
+                # ordered logit probabilities turned into odds with the bookmaker's margin
+                home_probability = 1 / (1 + np.exp(-(expected - 0.5) * 1.5))
+                away_probability = 1 / (1 + np.exp((expected + 0.5) * 1.5))
+                draw_probability = 1 - home_probability - away_probability
+
+                columns["home_team_id"] += home_team_ids.tolist()
+                columns["away_team_id"] += away_team_ids.tolist()
+                columns["goal_difference"] += goal_differences.tolist()
+                columns["result"] += np.sign(goal_differences).tolist()
+                columns["date"] += [season_start + 7 * round_number] * len(games)
+                columns["league_id"] += [league_id] * len(games)
+                columns["season"] += [season] * len(games)
+                for column, probability in [("home_odd", home_probability), ("draw_odd", draw_probability),
+                                            ("away_odd", away_probability)]:
+                    columns[column] += np.round(1 / (probability * (1 + BOOKMAKER_MARGIN)), 2).tolist()
+
+    columns["game_id"] = np.arange(1, len(columns["result"]) + 1)
+    df = pd.DataFrame(columns)
+    df["date"] = pd.to_datetime(df["date"])
+
+    return df.astype(COLUMN_TYPES)
+
+
+def get_api_body(games_df: pd.DataFrame) -> bytes:
+    # a fixtures response of API-Football with the fields that api_data_extraction reads
+    games = [{
+        "fixture": {"id": game.game_id, "date": f"{game.date:%Y-%m-%d}T15:00:00+00:00",
+                    "status": {"long": "Match Finished"}},
+        "teams": {"home": {"id": game.home_team_id, "winner": True if game.result == 1 else None if game.result == 0
+                           else False},
+                  "away": {"id": game.away_team_id, "winner": True if game.result == -1 else None if game.result == 0
+                           else False}},
+        "goals": {"home": max(game.goal_difference, 0) + 1, "away": max(-game.goal_difference, 0) + 1}
+    } for game in games_df.itertuples()]
+
+    return json.dumps({"paging": {"current": 1, "total": 1}, "response": games}).encode()
+
+
+def get_backtest(games_df: pd.DataFrame, seed: int = 0) -> dict:
+    # predictions of a model that is right more often than chance
+    rng = np.random.default_rng(seed)
+    labels = get_labels(games_df["result"].to_numpy())
+    probabilities = rng.dirichlet(np.ones(NUM_OF_OUTPUTS), games_df.shape[0]) + labels * 0.3
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    predictions = np.argmax(probabilities, axis=1)
+
+    return {
+        "game_id": games_df["game_id"].to_numpy(),
+        "probabilities": probabilities,
+        "confidence": probabilities[np.arange(games_df.shape[0]), predictions],
+        "prediction": predictions,
+        "result": np.argmax(labels, axis=1),
+        "result_odd": get_result_odds(games_df),
+        "odds": get_odds(games_df)
+    }
+
+
+def prepare_parse(games_df: pd.DataFrame, args):
+    bodies = [(get_api_body(season_games), league_id, season)
+              for (league_id, season), season_games in games_df.groupby(["league_id", "season"])]
+    return lambda: [parse_league_season_games(body, league_id, season) for body, league_id, season in bodies]
+
+
+def prepare_bulk_load(games_df: pd.DataFrame, args):
+    # games are loaded into a separate database that is dropped afterwards
+    connection = connect_to_db(host=args.host)
+    cursor = connection.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {DATABASE}_benchmark")
+    cursor.execute(f"CREATE DATABASE {DATABASE}_benchmark")
+    cursor.execute(f"USE {DATABASE}_benchmark")
+    create_games_table(cursor)
+
+    def run():
+        try:
+            bulk_load(cursor, "games", GAMES_COLUMNS, insert_into_games_table, games_df, args.batch_size)
+        finally:
+            cursor.execute(f"DROP DATABASE {DATABASE}_benchmark")
+            connection.close()
+
+    return run
+
+
+def prepare_features(games_df: pd.DataFrame, args):
+    return lambda: build_features(FormIndex(games_df), games_df, args.processes)
+
+
+def prepare_training(games_df: pd.DataFrame, args):
+    # tensorflow is imported only by this stage, the others can be benchmarked without it
+    import neural_net
+
+    storage.DATA_DIR = tempfile.mkdtemp()
+    data, labels, skipped = build_features(FormIndex(games_df), games_df, args.processes)
+    storage.save_features({
+        "game_id": games_df["game_id"].to_numpy()[~skipped], "date": games_df["date"].to_numpy()[~skipped],
+        "league_id": games_df["league_id"].to_numpy()[~skipped], "season": games_df["season"].to_numpy()[~skipped],
+        "data": data[~skipped], "labels": labels[~skipped]
+    }, "neural_net")
+
+    def run():
+        rows = neural_net.get_feature_rows()
+        train_indices, _ = neural_net.train_test_indices_split(len(rows))
+        neural_net.create_model(neural_net.make_input_pipeline(rows, train_indices, shuffle=True))
+
+    return run
+
+
+def prepare_grid_search(games_df: pd.DataFrame, args):
+    backtest = get_backtest(games_df, args.seed)
+    return lambda: run_grid_search(backtest, DEFAULT_GRID, args.processes, args.strategy)
+
+
+def prepare_bankroll_simulation(games_df: pd.DataFrame, args):
+    backtest = get_backtest(games_df, args.seed)
+    return lambda: simulate_grid(backtest, DEFAULT_GRID, args.paths, processes=args.processes, seed=args.seed,
+                                 strategy=args.strategy)
+
+
+STAGE_PREPARERS = {
+    "parse": prepare_parse, "bulk_load": prepare_bulk_load, "features": prepare_features,
+    "training": prepare_training, "grid_search": prepare_grid_search,
+    "bankroll_simulation": prepare_bankroll_simulation
+}
+
+
+def get_peak_memory() -> float:
+    # maximum resident set size in MB of this process and of the worker processes it waited for
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def run_stage(stage: str, num_of_leagues: int, args) -> dict:
+    # runs in a fresh process, so that peak memory of one measurement doesn't include the previous ones
+    games_df = generate_games(num_of_leagues, args.seasons, args.teams, args.seed)
+    run = STAGE_PREPARERS[stage](games_df, args)
+
+    memory_before = get_peak_memory()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    peak_memory = get_peak_memory()
+
+    return {
+        "stage": stage, "leagues": num_of_leagues, "games": games_df.shape[0], "seconds": round(seconds, 4),
+        "games_per_second": round(games_df.shape[0] / seconds, 1), "peak_memory_mb": round(peak_memory, 1),
+        "memory_increase_mb": round(peak_memory - memory_before, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--leagues", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="dataset sizes as numbers of leagues, every stage is run once per size")
+    parser.add_argument("--seasons", type=int, default=5)
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes used for features, grid search and bankroll simulation "
+                             "(0 - all cores)")
+    parser.add_argument("--paths", type=int, default=10000, help="number of paths of the bankroll simulation")
+    parser.add_argument("--strategy", choices=list(STRATEGIES), default="linear",
+                        help="staking strategy of the grid search and bankroll simulation")
+    # the bulk_load stage drops and creates a database, so it never runs against the production host by default
+    parser.add_argument("--host", default="localhost", help="database host for the bulk_load stage")
+    parser.add_argument("--batch-size", type=int, default=DB_BATCH_SIZE)
+    parser.add_argument("--output", default="data/benchmark.json")
+    args = parser.parse_args()
+
+    results = []
+    for stage in args.stages:
+        for num_of_leagues in args.leagues:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result = executor.submit(run_stage, stage, num_of_leagues, args).result()
+            print(f"{stage:>12} {result['games']:>8} games: {result['seconds']:.3f}s "
+                  f"({result['games_per_second']:.0f} games/s), peak memory {result['peak_memory_mb']:.0f} MB")
+            results.append(result)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump({"config": {key: value for key, value in vars(args).items() if key != "host"}, "results": results},
+                  file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,3 +27,23 @@ NUM_OF_OUTPUTS = 3
 NUM_OF_INPUTS = 2 * NUM_OF_LAST_GAMES + NUM_OF_LAST_HEAD2HEADS
 
 BOOKMAKER = 1
+
+API_CALLS_PER_MINUTE = 10
+API_BURST = 1
+API_MAX_CONNECTIONS = 10
+API_MAX_RETRIES = 5
+API_BACKOFF_SECONDS = 2
+
+API_CACHE_DIR = "data/api_cache"
+# responses for finished seasons never expire, these TTLs (in seconds) are for data that can still change
+API_CACHE_CURRENT_SEASON_TTL = 6 * 60 * 60
+API_CACHE_ODDS_TTL = 60 * 60
+
+DB_BATCH_SIZE = 5000
+DB_POOL_SIZE = 4
+DB_CHUNK_SIZE = 50000
+
+SERVICE_PORT = 8080
+# concurrent prediction requests are collected for at most SERVICE_MAX_BATCH_DELAY seconds into one batch
+SERVICE_MAX_BATCH_SIZE = 1024
+SERVICE_MAX_BATCH_DELAY = 0.002
@@ -0,0 +1,156 @@
+import queue
+import threading
+import pymysql
+import pymysql.cursors
+import pandas as pd
+import pyarrow as pa
+from contextlib import contextmanager
+from constants import *
+
+DATABASE = "football_prediction_db"
+GAMES_COLUMNS = ["game_id", "home_team_id", "away_team_id", "result", "goal_difference", "date", "league_id", "season"]
+EVAL_COLUMNS = GAMES_COLUMNS + ["home_odd", "draw_odd", "away_odd"]
+TABLE_COLUMNS = {"games": GAMES_COLUMNS, "evaluation": EVAL_COLUMNS}
+# types the columns of games and evaluation tables are read as
+COLUMN_TYPES = {
+    "game_id": "int32", "home_team_id": "int32", "away_team_id": "int32", "result": "int8",
+    "goal_difference": "int32", "date": "datetime64[s]", "league_id": "int32", "season": "int32",
+    "home_odd": "float32", "draw_odd": "float32", "away_odd": "float32"
+}
+
+
+def connect_to_db(host: str = HOST, user: str = USERNAME, password: str = PASSWORD, database: str or None = None,
+                  local_infile: bool = False):
+    connection = pymysql.connect(host=host, user=user, password=password, database=database,
+                                 local_infile=local_infile)
+
+    if connection:
+        print('Connected!')
+        return connection
+    else:
+        raise Exception("Something went wrong...")
+
+
+class ConnectionPool:
+    # Keeps up to 'size' open connections to the database and hands them out one at a time,
+    # so that the stages of the pipeline don't reconnect for every query.
+
+    def __init__(self, size: int = DB_POOL_SIZE, **connect_kwargs):
+        self.size = size
+        # defaults are filled in, so the arguments of a later get_pool call can be compared with them
+        self.connect_kwargs = {"host": HOST, "user": USERNAME, "password": PASSWORD, "database": DATABASE,
+                               **connect_kwargs}
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.size
+                self.created += can_create
+            connection = connect_to_db(**self.connect_kwargs) if can_create else self.idle.get()
+
+        # reconnecting if the server closed the connection while it was idle
+        connection.ping(reconnect=True)
+        return connection
+
+    def release(self, connection):
+        # uncommitted changes of the previous user must not leak to the next one
+        connection.rollback()
+        self.idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+            self.created -= 1
+
+
+pool = None
+
+
+def get_pool(**connect_kwargs) -> ConnectionPool:
+    # one pool is shared by all stages that run in the same process, it is created by the first call.
+    # Later calls without arguments get the same pool, calls with other connection arguments are an error,
+    # otherwise a stage could silently read from a different database than the one it was asked for.
+    global pool
+    if pool is None:
+        pool = ConnectionPool(**connect_kwargs)
+    elif any(pool.connect_kwargs.get(name) != value for name, value in connect_kwargs.items()):
+        raise ValueError(f"the connection pool was already created with other arguments than {connect_kwargs}")
+    return pool
+
+
+def build_select(table: str, columns: list or None = None, seasons: tuple or None = None,
+                 leagues: list or None = None, where: str or None = None, params: tuple = ()):
+    # filters are applied by the database, so only the needed rows and columns are sent to us
+    conditions, query_params = [], []
+    if seasons is not None:
+        conditions.append("season BETWEEN %s AND %s")
+        query_params += [seasons[0], seasons[1]]
+    if leagues is not None:
+        conditions.append(f"league_id IN ({', '.join(['%s'] * len(leagues))})")
+        query_params += list(leagues)
+    if where is not None:
+        conditions.append(f"({where})")
+        query_params += list(params)
+
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+    if conditions:
+        query += f" WHERE {' AND '.join(conditions)}"
+
+    return query, tuple(query_params)
+
+
+def get_typed_df(rows: list, columns: list) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=columns)
+    for column in columns:
+        if column == "date":
+            df[column] = pd.to_datetime(df[column]).astype(COLUMN_TYPES[column])
+        elif column in COLUMN_TYPES:
+            df[column] = df[column].astype(COLUMN_TYPES[column])
+
+    return df
+
+
+def read_chunks(table: str, columns: list or None = None, seasons: tuple or None = None,
+                leagues: list or None = None, where: str or None = None, params: tuple = (),
+                chunk_size: int = DB_CHUNK_SIZE):
+    # a server-side cursor streams rows, so we never hold more than one chunk of raw rows at a time
+    query, query_params = build_select(table, columns, seasons, leagues, where, params)
+    with get_pool().connection() as connection:
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query, query_params)
+            column_names = [description[0] for description in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield get_typed_df(rows, column_names)
+
+
+def read_table(table: str, columns: list or None = None, seasons: tuple or None = None,
+               leagues: list or None = None, where: str or None = None, params: tuple = (),
+               chunk_size: int = DB_CHUNK_SIZE) -> pd.DataFrame:
+    chunks = list(read_chunks(table, columns, seasons, leagues, where, params, chunk_size))
+    if not chunks:
+        return get_typed_df([], columns or TABLE_COLUMNS[table])
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_arrow_batches(table: str, columns: list or None = None, seasons: tuple or None = None,
+                       leagues: list or None = None, where: str or None = None, params: tuple = (),
+                       chunk_size: int = DB_CHUNK_SIZE):
+    for chunk in read_chunks(table, columns, seasons, leagues, where, params, chunk_size):
+        yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
@@ -1,127 +1,288 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
 import pandas as pd
 import numpy as np
-from tensorflow import keras
+from multiprocessing import shared_memory
+from constants import *
+import instrumentation
+from inference import load_model
+from odds_store import load_odds_store
+from staking import STRATEGIES, StakingStrategy
+from storage import load_features, save_results
 
 MONEY = 1000
+DEFAULT_GRID = STRATEGIES["linear"].default_grid
+METRIC_COLUMNS = ["gain", "biggest_win", "biggest_loss", "average_bet", "average_gain", "no_bets", "bets_won",
+                  "bets_lost"]
 
 
-def make_bet(prediction: np.array, result: np.array, bet: float, odd: float):
-    if prediction == np.argmax(result):
-        return bet * odd - bet
-    else:
-        return -bet
+def get_eval_results_columns(strategy: StakingStrategy) -> list:
+    return ["strategy"] + strategy.params + METRIC_COLUMNS
 
 
-def predict(model, game: np.array):
-    probabilities = model(np.array([game]), training=False).numpy()
-    prediction = np.argmax(probabilities)
-    return probabilities[0][prediction], prediction
+def make_bet(outcomes: np.array, results: np.array, bets: np.array, odds: np.array) -> np.array:
+    # 'odds' are the odds of the results, we only need the odd of the outcome we bet on if it won
+    return np.where(outcomes == results, bets * odds - bets, -bets)
 
 
-def determine_bet(confidence: float, min_prediction_confidence: float, min_bet: int, max_bet: int):
-    bet_increase_per_confidence_percent = (max_bet - min_bet) / (100 - min_prediction_confidence * 100)
+@instrumentation.timed("evaluation.get_backtest")
+def get_backtest(model, dataset: dict) -> dict:
+    # running the model once over the whole evaluation set instead of once per game
+    probabilities = model.predict(dataset["data"], batch_size=4096)
+    predictions = np.argmax(probabilities, axis=1)
 
-    if 0.7 <= confidence <= 1:
-        bet_increase_per_confidence_percent *= 1.5
+    return {
+        "game_id": dataset["game_id"],
+        "probabilities": probabilities,
+        "confidence": probabilities[np.arange(probabilities.shape[0]), predictions].astype(np.float64),
+        "prediction": predictions,
+        "result": np.argmax(dataset["labels"], axis=1),
+        "result_odd": dataset["result_odd"],
+        # features stored before odds of all outcomes were added can be used only by strategies that don't need them
+        **({"odds": dataset["odds"]} if "odds" in dataset else {})
+    }
 
-    bet = min_bet + bet_increase_per_confidence_percent * (confidence * 100 - min_prediction_confidence * 100)
 
-    if bet < min_bet:
-        return min_bet
-    elif bet > max_bet:
-        return max_bet
+def use_market_odds(backtest: dict, store, source: str, bookmaker: int) -> dict:
+    # replacing odds of the dataset with the closing line of one bookmaker or the best closing price of all of them
+    if source == "best":
+        odds = store.best_odds(backtest["game_id"])
+    else:
+        odds = store.closing_odds(backtest["game_id"], bookmaker)
+    result_odd = odds[np.arange(odds.shape[0]), backtest["result"]].astype(np.float64)
 
-    return bet
+    # games the store has no odds for keep the odds they have in the dataset
+    print(f"{np.isnan(result_odd).sum()} of {result_odd.shape[0]} games have no {source} odds in the odds store")
+    return {**backtest, "result_odd": np.where(np.isnan(result_odd), backtest["result_odd"], result_odd),
+            "odds": np.where(np.isnan(odds), backtest.get("odds", np.nan), odds)}
 
 
-def evaluate(model, df: pd.DataFrame, min_bet_limit: int, max_bet_limit: int, min_prediction_confidence: float,
-             store_bets=False) -> pd.Series or None:
-    if store_bets:
-        bets = pd.DataFrame(columns=["game_id", "bet", "odd", "gain", "money"])
+def get_stakes(backtest: dict, strategy: StakingStrategy, combinations: np.array) -> tuple:
+    # stakes of every game for every combination, the profit of one unit staked on the outcome we bet on and the outcome
+    outcomes, amounts, fractions = strategy.get_stakes(backtest["probabilities"], backtest.get("odds"), combinations)
+    return amounts, fractions, make_bet(outcomes, backtest["result"], 1, backtest["result_odd"]), outcomes
+
+
+def simulate_bankroll(amounts: np.array, fractions: np.array, returns: np.array):
+    # we can't bet more money than we have, therefore this part depends on the previous bets and stays sequential
+    placed_bets = np.empty(amounts.shape[0])
+    gains = np.empty(amounts.shape[0])
+    money_history = np.empty(amounts.shape[0])
     money = MONEY
-    bets_made = 0
-    bets_won = 0
-    biggest_win = 0
-    biggest_loss = 0
-    bet_sum = 0
-    for i, game in df.iterrows():
-        confidence, prediction = predict(model, game["data"])
-        if confidence >= min_prediction_confidence:
-            bet = determine_bet(confidence, min_prediction_confidence, min_bet_limit, max_bet_limit)
-            if bet > money:
-                bet = money * 0.75
-            gain = make_bet(prediction, game["label"], bet, game["result_odd"])
-            money += gain
-            if store_bets:
-                bets.loc[len(bets.index)] = pd.Series({"game_id": game.game_id, "bet": bet, "odd": game["result_odd"],
-                                                       "gain": gain, "money": money})
-            if money < 0:
-                return None
-            bet_sum += bet
-            bets_made += 1
-            if gain > biggest_win:
-                biggest_win = gain
-            elif gain < biggest_loss:
-                biggest_loss = gain
-
-            if gain > 0:
-                bets_won += 1
+    for i, (amount, fraction, unit_return) in enumerate(zip(amounts.tolist(), fractions.tolist(), returns.tolist())):
+        bet = amount + fraction * money
+        if bet > money:
+            bet = money * 0.75
+        gain = bet * unit_return
+        money += gain
+        placed_bets[i], gains[i], money_history[i] = bet, gain, money
+        if money < 0:
+            return None
+
+    return placed_bets, gains, money_history
+
+
+@instrumentation.timed("evaluation.evaluate")
+def evaluate(backtest: dict, params: dict, strategy: str = "linear", store_bets=False) -> pd.Series or None:
+    strategy = STRATEGIES[strategy]
+    amounts, fractions, returns, outcomes = get_stakes(
+        backtest, strategy, np.array([[params[param] for param in strategy.params]], dtype=np.float64))
+    num_of_games = returns.shape[0]
+    bet_games = np.flatnonzero((amounts[:, 0] > 0) | (fractions[:, 0] > 0))
+    odds = backtest["result_odd"][bet_games]
+
+    simulation = simulate_bankroll(amounts[bet_games, 0], fractions[bet_games, 0], returns[bet_games])
+    if simulation is None:
+        return None
+    placed_bets, gains, money_history = simulation
 
+    bets_made = bet_games.shape[0]
     if bets_made == 0:
         return None
 
+    gain = money_history[-1] - MONEY
+    bets_won = int((gains > 0).sum())
     data = {
-        "min_bet_limit": min_bet_limit, "max_bet_limit": max_bet_limit,
-        "min_prediction_confidence": min_prediction_confidence, "gain": money - MONEY,
-        "biggest_win": biggest_win, "biggest_loss": biggest_loss, "average_bet": round(bet_sum / bets_made),
-        "average_gain": (money - MONEY) / bets_made, "no_bets": round((df.shape[0] - bets_made) / df.shape[0], 3),
-        "bets_won": round(bets_won / df.shape[0], 3), "bets_lost": round((bets_made - bets_won) / df.shape[0], 3)
+        "strategy": strategy.name, **{param: params[param] for param in strategy.params}, "gain": gain,
+        "biggest_win": max(gains.max(), 0), "biggest_loss": min(gains.min(), 0),
+        "average_bet": round(placed_bets.sum() / bets_made), "average_gain": gain / bets_made,
+        "no_bets": round((num_of_games - bets_made) / num_of_games, 3),
+        "bets_won": round(bets_won / num_of_games, 3), "bets_lost": round((bets_made - bets_won) / num_of_games, 3)
     }
-    eval_result = pd.Series(data=data, index=[
-        "min_bet_limit", "max_bet_limit", "min_prediction_confidence", "gain", "biggest_win",
-        "biggest_loss", "average_bet", "average_gain", "no_bets", "bets_won", "bets_lost"
-    ])
+    eval_result = pd.Series(data=data, index=get_eval_results_columns(strategy))
 
     if store_bets:
-        bets.to_pickle("data/best_params.pkl")
+        bets_df = pd.DataFrame({"game_id": backtest["game_id"][bet_games], "outcome": outcomes[bet_games],
+                                "bet": placed_bets, "odd": odds, "gain": gains, "money": money_history})
+        save_results(bets_df, "best_params")
 
     return eval_result
 
 
-def get_best_parameters(model, df: pd.DataFrame):
-    eval_results = pd.DataFrame(columns=[
-        "min_bet_limit", "max_bet_limit", "min_prediction_confidence", "gain", "biggest_win",
-        "biggest_loss", "average_bet", "average_gain", "no_bets", "bets_won", "bets_lost"])
+def get_parameter_combinations(grid: dict, strategy: StakingStrategy = STRATEGIES["linear"]) -> np.array:
+    # combinations are ordered like nested loops over the parameters of the strategy
+    combinations = np.array(list(itertools.product(*strategy.get_grid(grid).values())),
+                            dtype=np.float64).reshape(-1, len(strategy.params))
+    if "min_bet_limit" in strategy.params and "max_bet_limit" in strategy.params:
+        combinations = combinations[combinations[:, strategy.params.index("min_bet_limit")]
+                                    <= combinations[:, strategy.params.index("max_bet_limit")]]
+
+    return combinations
+
+
+def simulate_grid(amounts: np.array, fractions: np.array, returns: np.array) -> tuple:
+    # the same simulation as in evaluate, but the games are replayed once for all parameter combinations at a time
+    num_of_combinations = amounts.shape[1]
+    money = np.full(num_of_combinations, MONEY, dtype=np.float64)
+    solvent = np.ones(num_of_combinations, dtype=bool)
+    bets_made = np.zeros(num_of_combinations, dtype=np.int64)
+    bets_won = np.zeros(num_of_combinations, dtype=np.int64)
+    bet_sum = np.zeros(num_of_combinations)
+    biggest_win = np.zeros(num_of_combinations)
+    biggest_loss = np.zeros(num_of_combinations)
+
+    # games that no combination bets on don't change the bankroll
+    bet_games = np.flatnonzero((amounts > 0).any(axis=1) | (fractions > 0).any(axis=1))
+    for game_amounts, game_fractions, unit_return in zip(amounts[bet_games], fractions[bet_games],
+                                                         returns[bet_games].tolist()):
+        bets = game_amounts + game_fractions * money
+        betting = solvent & (bets > 0)
+        bets = np.where(bets > money, money * 0.75, bets)
+        gains = np.where(betting, bets * unit_return, 0)
+
+        money += gains
+        bets_made += betting
+        bets_won += gains > 0
+        bet_sum += np.where(betting, bets, 0)
+        np.maximum(biggest_win, gains, out=biggest_win)
+        np.minimum(biggest_loss, gains, out=biggest_loss)
+        solvent &= money >= 0
+
+    num_of_games = returns.shape[0]
+    valid = solvent & (bets_made > 0)
+    bets_made = np.maximum(bets_made, 1)
+    eval_results = pd.DataFrame({
+        "gain": money - MONEY, "biggest_win": biggest_win, "biggest_loss": biggest_loss,
+        "average_bet": np.round(bet_sum / bets_made), "average_gain": (money - MONEY) / bets_made,
+        "no_bets": np.round((num_of_games - bets_made) / num_of_games, 3),
+        "bets_won": np.round(bets_won / num_of_games, 3), "bets_lost": np.round((bets_made - bets_won) / num_of_games, 3)
+    }, columns=METRIC_COLUMNS)
+
+    return eval_results, valid
+
+
+def share_arrays(arrays: dict):
+    # copying arrays to shared memory once, so that workers read them without receiving a copy with every task
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
 
-    for min_bet_limit in [10, 20, 50, 75]:
-        for max_bet_limit in [50, 100, 200, 500]:
-            if min_bet_limit > max_bet_limit:
-                continue
-            for min_prediction_confidence in [0.4, 0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8]:
-                ser = evaluate(model, df, min_bet_limit, max_bet_limit, min_prediction_confidence)
-                if ser is not None:
-                    eval_results.loc[len(eval_results.index)] = ser
+    return blocks, specs
 
-    eval_results.to_pickle("data/eval_results.pkl")
+
+def init_grid_worker(specs: dict):
+    global worker_blocks, worker_arrays
+    worker_blocks = {name: shared_memory.SharedMemory(name=block_name) for name, (block_name, _, _) in specs.items()}
+    worker_arrays = {name: np.ndarray(shape, dtype=dtype, buffer=worker_blocks[name].buf)
+                     for name, (_, shape, dtype) in specs.items()}
+
+
+def simulate_grid_chunk(columns: tuple) -> tuple:
+    # every worker simulates a range of combinations, which are columns of the stake tables
+    start, end = columns
+    return simulate_grid(worker_arrays["amounts"][:, start:end], worker_arrays["fractions"][:, start:end],
+                         worker_arrays["returns"])
+
+
+@instrumentation.timed("evaluation.run_grid_search")
+def run_grid_search(backtest: dict, grid: dict, processes: int = 1, strategy: str = "linear") -> pd.DataFrame:
+    strategy = STRATEGIES[strategy]
+    combinations = get_parameter_combinations(grid, strategy)
+    # stakes of all games and combinations are computed at once, only the bankroll is replayed game by game
+    amounts, fractions, returns, _ = get_stakes(backtest, strategy, combinations)
+    if processes == 1:
+        metrics, valid = simulate_grid(amounts, fractions, returns)
+    else:
+        processes = processes or os.cpu_count()
+        blocks, specs = share_arrays({"amounts": amounts, "fractions": fractions, "returns": returns})
+        try:
+            with multiprocessing.Pool(processes, initializer=init_grid_worker, initargs=(specs,)) as pool:
+                bounds = np.linspace(0, combinations.shape[0], min(processes * 4, max(combinations.shape[0], 1)) + 1)
+                chunks = pool.map(simulate_grid_chunk, zip(bounds[:-1].astype(int), bounds[1:].astype(int)))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        metrics = pd.concat([chunk_metrics for chunk_metrics, _ in chunks], ignore_index=True)
+        valid = np.concatenate([chunk_valid for _, chunk_valid in chunks])
+
+    eval_results = pd.concat([pd.DataFrame(combinations, columns=strategy.params), metrics], axis=1)
+    eval_results.insert(0, "strategy", strategy.name)
+
+    return eval_results[valid].reset_index(drop=True)
+
+
+def get_best_parameters(backtest: dict, grid: dict = DEFAULT_GRID, processes: int = 1,
+                        strategies: list = ("linear",)):
+    # grids of all strategies are saved together, so they can be compared on the same evaluation set
+    eval_results = pd.concat([run_grid_search(backtest, grid, processes, strategy) for strategy in strategies],
+                             ignore_index=True)
+    save_results(eval_results, "eval_results")
 
     return eval_results.sort_values("gain", ascending=False, ignore_index=True).loc[0]
 
 
-def main():
-    df = pd.read_pickle("data/neural_net_eval.pkl")
+def get_evaluation_dataset() -> dict:
+    return load_features("neural_net_eval")
+
+
+def run_evaluation(grid: dict = DEFAULT_GRID, processes: int = 1, odds: str = "dataset",
+                   bookmaker: int = BOOKMAKER, strategies: list = ("linear",)):
+    dataset = get_evaluation_dataset()
 
-    # loading model saved in neural_net.py
-    model = keras.models.load_model('neural_net')
+    # loading weights exported in neural_net.py, the forward pass runs in numpy without tensorflow
+    model = load_model()
+
+    # predicting all evaluation games at once, the probabilities are reused by every evaluation below
+    backtest = get_backtest(model, dataset)
+    if odds != "dataset":
+        backtest = use_market_odds(backtest, load_odds_store(), odds, bookmaker)
 
     # getting the best betting parameters
-    # min_bet_limit: min amount of money we can bet on a game
-    # max_bet_limit: max amount of money we can bet on a game
-    # min_prediction_confidence: min probability of the result that we are going to bet on
-    best_params = get_best_parameters(model, df)
-
-    # evaluating model with the best parameters and storing bets
-    evaluate(model, df, best_params.min_bet_limit, best_params.max_bet_limit, best_params.min_prediction_confidence,
-             True)
+    best_params = get_best_parameters(backtest, grid, processes, strategies)
+
+    # evaluating model with the best strategy and parameters and storing bets
+    evaluate(backtest, best_params.to_dict(), best_params.strategy, True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", help="path to a json file with lists of values of the strategy parameters "
+                                       "to search through, parameters that are not in the file use default values")
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=["linear"],
+                        help="staking strategies to search through, the best parameters of all of them are stored")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes used for the grid search (0 - all cores)")
+    parser.add_argument("--odds", choices=["dataset", "closing", "best"], default="dataset",
+                        help="bet at the odds of the dataset, the closing line of --bookmaker from the odds store, "
+                             "or the best closing price of all bookmakers")
+    parser.add_argument("--bookmaker", type=int, default=BOOKMAKER)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(args)
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as file:
+            grid = json.load(file)
+
+    run_evaluation(grid, args.processes, args.odds, args.bookmaker, args.strategies)
 
 
 if __name__ == "__main__":
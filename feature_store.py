@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from constants import *
+from form_index import to_days
+
+FEATURE_STORE_DIR = "data/feature_store"
+# columns that the features of a game and of the games after it are computed from
+SOURCE_COLUMNS = ["home_team_id", "away_team_id", "league_id", "day", "goal_difference"]
+# constants the features are computed with, a store computed with other values is rebuilt from scratch
+FEATURE_CONSTANTS = {
+    "NUM_OF_LAST_GAMES": NUM_OF_LAST_GAMES,
+    "NUM_OF_LAST_HEAD2HEADS": NUM_OF_LAST_HEAD2HEADS,
+    "MIN_NUM_OF_LAST_GAMES": MIN_NUM_OF_LAST_GAMES,
+    "MIN_NUM_OF_LAST_HEAD2HEADS": MIN_NUM_OF_LAST_HEAD2HEADS,
+    "MAX_DAYS_SINCE_GAME": MAX_DAYS_SINCE_GAME,
+    "MAX_DAYS_SINCE_HEAD2HEAD": MAX_DAYS_SINCE_HEAD2HEAD
+}
+
+
+def get_sources(df: pd.DataFrame) -> pd.DataFrame:
+    sources = pd.DataFrame({
+        "game_id": df["game_id"].to_numpy(dtype=np.int64),
+        "home_team_id": df["home_team_id"].to_numpy(dtype=np.int64),
+        "away_team_id": df["away_team_id"].to_numpy(dtype=np.int64),
+        "league_id": df["league_id"].to_numpy(dtype=np.int64),
+        "day": to_days(df["date"]),
+        "goal_difference": df["goal_difference"].to_numpy(dtype=np.int64)
+    })
+
+    return sources
+
+
+def load_store(name: str) -> dict or None:
+    path = os.path.join(FEATURE_STORE_DIR, f"{name}.npz")
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as store:
+        store = dict(store)
+
+    # stores saved before the constants were recorded are rebuilt too
+    constants = store.pop("feature_constants", None)
+    if constants is None or constants.tolist() != list(FEATURE_CONSTANTS.values()):
+        print(f"{name}: feature constants changed, rebuilding the feature store")
+        return None
+
+    return store
+
+
+def save_store(name: str, store: dict):
+    os.makedirs(FEATURE_STORE_DIR, exist_ok=True)
+    np.savez(os.path.join(FEATURE_STORE_DIR, f"{name}.npz"), **store,
+             feature_constants=np.array(list(FEATURE_CONSTANTS.values()), dtype=np.int64))
+
+
+def load_watermark() -> dict:
+    path = os.path.join(FEATURE_STORE_DIR, "watermark.json")
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        return {int(league_id): day for league_id, day in json.load(file).items()}
+
+
+def save_watermark(sources: pd.DataFrame):
+    # watermark is the date of the latest game of every league that features were computed with
+    watermark = sources.groupby("league_id")["day"].max()
+    os.makedirs(FEATURE_STORE_DIR, exist_ok=True)
+    with open(os.path.join(FEATURE_STORE_DIR, "watermark.json"), "w") as file:
+        json.dump({str(league_id): int(day) for league_id, day in watermark.items()}, file, indent=4)
+
+
+def get_store_sources(store: dict) -> pd.DataFrame:
+    return pd.DataFrame({column: store[column] for column in ["game_id"] + SOURCE_COLUMNS})
+
+
+def get_changed_games(store: dict or None, sources: pd.DataFrame):
+    # returns a mask of the games that are new or differ from the stored ones
+    # and the stored versions of the games that were changed or removed since then
+    if store is None:
+        return np.ones(sources.shape[0], dtype=bool), sources.iloc[:0]
+
+    stored_sources = get_store_sources(store)
+    merged = sources.merge(stored_sources, on="game_id", how="left", suffixes=("", "_stored"), indicator=True)
+    changed = (merged["_merge"] == "left_only").to_numpy().copy()
+    for column in SOURCE_COLUMNS:
+        changed |= (merged[column] != merged[f"{column}_stored"]).to_numpy()
+
+    unchanged_game_ids = sources["game_id"][~changed]
+    previous = stored_sources[~stored_sources["game_id"].isin(unchanged_game_ids)]
+
+    return changed, previous
+
+
+def count_late_games(sources: pd.DataFrame, changed: np.array, watermark: dict) -> int:
+    # late games are new or corrected games that are not newer than the latest game of their league
+    league_watermarks = sources["league_id"].map(watermark)
+    return int((changed & (sources["day"] <= league_watermarks).to_numpy()).sum())
+
+
+def stack_teams(games: pd.DataFrame, day_column: str) -> pd.DataFrame:
+    # every game is represented once for the home team and once for the away team
+    return pd.DataFrame({
+        "team_id": np.concatenate((games["home_team_id"].to_numpy(), games["away_team_id"].to_numpy())),
+        "league_id": np.concatenate((games["league_id"].to_numpy(), games["league_id"].to_numpy())),
+        day_column: np.concatenate((games["day"].to_numpy(), games["day"].to_numpy()))
+    })
+
+
+def get_pairs(games: pd.DataFrame, day_column: str) -> pd.DataFrame:
+    return pd.DataFrame({
+        "first_team_id": np.minimum(games["home_team_id"].to_numpy(), games["away_team_id"].to_numpy()),
+        "second_team_id": np.maximum(games["home_team_id"].to_numpy(), games["away_team_id"].to_numpy()),
+        day_column: games["day"].to_numpy()
+    })
+
+
+def get_invalidated_games(sources: pd.DataFrame, dirty_games: pd.DataFrame) -> np.array:
+    # a game has to be recomputed if one of the dirty games is inside the window of its last games or head2heads
+    invalidated = np.zeros(sources.shape[0], dtype=bool)
+    if dirty_games.shape[0] == 0:
+        return invalidated
+
+    teams = stack_teams(sources, "day")
+    teams["position"] = np.concatenate((np.arange(sources.shape[0]), np.arange(sources.shape[0])))
+    merged = teams.merge(stack_teams(dirty_games, "dirty_day"), on=["team_id", "league_id"])
+    days = merged["day"] - merged["dirty_day"]
+    invalidated[merged["position"][(days > 0) & (days < MAX_DAYS_SINCE_GAME)]] = True
+
+    pairs = get_pairs(sources, "day")
+    pairs["position"] = np.arange(sources.shape[0])
+    merged = pairs.merge(get_pairs(dirty_games, "dirty_day"), on=["first_team_id", "second_team_id"])
+    days = merged["day"] - merged["dirty_day"]
+    invalidated[merged["position"][(days > 0) & (days < MAX_DAYS_SINCE_HEAD2HEAD)]] = True
+
+    return invalidated
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+NANOSECONDS_PER_DAY = 86400 * 10 ** 9
+
+
+def to_day(date) -> int:
+    # converting a date to the number of days since epoch
+    return pd.Timestamp(date).value // NANOSECONDS_PER_DAY
+
+
+def to_days(dates) -> np.array:
+    # vectorized version of to_day
+    return pd.to_datetime(pd.Series(dates)).to_numpy().astype("datetime64[D]").astype(np.int64)
+
+
+def group_by_key(first_keys: np.array, second_keys: np.array, positions: np.array,
+                 days: np.array, results: np.array) -> dict:
+    # sorting by key and then by position in games_df so that inside each key games keep their original order
+    order = np.lexsort((positions, second_keys, first_keys))
+    first_keys, second_keys = first_keys[order], second_keys[order]
+    days, results = days[order], results[order]
+
+    groups = {}
+    key_changes = np.flatnonzero((np.diff(first_keys) != 0) | (np.diff(second_keys) != 0)) + 1
+    starts = np.concatenate(([0], key_changes))
+    ends = np.concatenate((key_changes, [len(order)]))
+    for start, end in zip(starts, ends):
+        key_days = days[start:end]
+        # binary search is only valid if the games of this key are stored in chronological order,
+        # otherwise we fall back to scanning the key's games (see last_results)
+        is_sorted = bool(np.all(np.diff(key_days) >= 0))
+        groups[(int(first_keys[start]), int(second_keys[start]))] = (key_days, results[start:end], is_sorted)
+
+    return groups
+
+
+def last_results(entry: tuple or None, day: int, max_days: int, n: int) -> list:
+    # returns results of last n games that happened less than 'max_days' days before 'day', the latest one first
+    if entry is None:
+        return []
+    days, results, is_sorted = entry
+
+    if is_sorted:
+        start = np.searchsorted(days, day - max_days, side="right")
+        end = np.searchsorted(days, day, side="left")
+        return results[max(start, end - n):end][::-1].tolist()
+
+    in_window = np.flatnonzero((day - days > 0) & (day - days < max_days))
+    return results[in_window[::-1][:n]].tolist()
+
+
+def append_result(groups: dict, key: tuple, day: int, result: int):
+    # the entry is replaced instead of changed, so a reader that already got the old entry still sees consistent data
+    entry = groups.get(key)
+    if entry is None:
+        groups[key] = (np.array([day], dtype=np.int64), np.array([result], dtype=np.int64), True)
+    else:
+        days, results, is_sorted = entry
+        groups[key] = (np.append(days, day), np.append(results, result), is_sorted and bool(days[-1] <= day))
+
+
+class FormIndex:
+    # Precomputed history of goal differences used to build the features of the neural network.
+    # team_games maps (team_id, league_id) to the games of the team in the league,
+    # head2heads maps (smaller_team_id, bigger_team_id) to the games between two teams.
+    # Each entry is a tuple of (days since epoch, goal differences, is_sorted) where goal differences
+    # are signed from the point of view of the team (or the team with smaller id for head2heads)
+    # and games keep the order they have in games_df.
+
+    def __init__(self, games_df: pd.DataFrame):
+        days = to_days(games_df["date"])
+        home_team_ids = games_df["home_team_id"].to_numpy(dtype=np.int64)
+        away_team_ids = games_df["away_team_id"].to_numpy(dtype=np.int64)
+        league_ids = games_df["league_id"].to_numpy(dtype=np.int64)
+        goal_differences = games_df["goal_difference"].to_numpy(dtype=np.int64)
+        positions = np.arange(games_df.shape[0])
+
+        # every game is stored twice: for the home team as it is and for the away team with negated goal difference
+        self.team_games = group_by_key(
+            np.concatenate((home_team_ids, away_team_ids)), np.concatenate((league_ids, league_ids)),
+            np.concatenate((positions, positions)), np.concatenate((days, days)),
+            np.concatenate((goal_differences, -goal_differences)))
+
+        first_team_ids = np.minimum(home_team_ids, away_team_ids)
+        self.head2heads = group_by_key(
+            first_team_ids, np.maximum(home_team_ids, away_team_ids), positions, days,
+            np.where(home_team_ids == first_team_ids, goal_differences, -goal_differences))
+
+    def add_game(self, home_team_id: int, away_team_id: int, league_id: int, day: int, goal_difference: int):
+        # the index ends up the same as if the game was appended to games_df before building it
+        append_result(self.team_games, (home_team_id, league_id), day, goal_difference)
+        append_result(self.team_games, (away_team_id, league_id), day, -goal_difference)
+        append_result(self.head2heads, (min(home_team_id, away_team_id), max(home_team_id, away_team_id)), day,
+                      goal_difference if home_team_id < away_team_id else -goal_difference)
+
+    def last_team_results(self, team_id: int, league_id: int, n: int, day: int, max_days: int) -> list:
+        return last_results(self.team_games.get((team_id, league_id)), day, max_days, n)
+
+    def last_head2head_results(self, home_team_id: int, away_team_id: int, n: int, day: int, max_days: int) -> list:
+        games_results = last_results(
+            self.head2heads.get((min(home_team_id, away_team_id), max(home_team_id, away_team_id))), day, max_days, n)
+        if home_team_id > away_team_id:
+            games_results = [-result for result in games_results]
+        return games_results
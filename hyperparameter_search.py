@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import numpy as np
+from tensorflow import keras
+import neural_net
+from neural_net import (get_feature_rows, get_walk_forward_folds, get_partition_indices, build_model,
+                        make_input_pipeline, get_training_pool)
+from storage import hash_path
+
+STUDY_DIR = "data/hyperparameter_search"
+STUDY_PATH = os.path.join(STUDY_DIR, "study.json")
+# learning rates are sampled log-uniformly between the two bounds, the other parameters from the lists
+SEARCH_SPACE = {
+    "units": [[64], [128], [256], [512], [128, 64], [256, 128], [512, 256]],
+    "activation": ["sigmoid", "relu", "tanh"],
+    "learning_rate": [1e-4, 1e-2],
+    "batch_size": [256, 512, 1024, 2048, 4096]
+}
+# epochs without a better validation loss after which a trial stops before the end of its rung
+PATIENCE = 3
+
+
+def sample_params(seed: int, trial: int) -> dict:
+    # every trial has its own generator, so a resumed study samples the same configurations again
+    rng = np.random.default_rng([seed, trial])
+    low, high = np.log10(SEARCH_SPACE["learning_rate"])
+    return {
+        "units": SEARCH_SPACE["units"][rng.integers(len(SEARCH_SPACE["units"]))],
+        "activation": str(rng.choice(SEARCH_SPACE["activation"])),
+        "learning_rate": float(10 ** rng.uniform(low, high)),
+        "batch_size": int(rng.choice(SEARCH_SPACE["batch_size"]))
+    }
+
+
+def get_brackets(min_epochs: int, max_epochs: int, eta: int) -> list:
+    # Hyperband: every bracket is a successive halving run given as a list of (trials, epochs) rungs.
+    # The first bracket starts many trials with few epochs and the last one a few trials with all epochs,
+    # so a configuration that learns slowly isn't always pruned after its first epochs.
+    s_max = int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9))
+    brackets = []
+    for s in range(s_max, -1, -1):
+        num_of_trials = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        brackets.append([(num_of_trials // eta ** i, int(round(max_epochs / eta ** (s - i)))) for i in range(s + 1)])
+
+    return brackets
+
+
+def get_score(trial: dict, epochs: int) -> float:
+    # the best validation loss within the first 'epochs' epochs, a diverged trial is the worst
+    losses = [loss for loss in trial["val_loss"][:epochs] if math.isfinite(loss)]
+    return min(losses, default=math.inf)
+
+
+def get_rung(study: dict, trial_ids: list, rungs: list, level: int) -> list:
+    # trials of a bracket that reached this rung, only the best 1 / eta of every rung are promoted to the next one
+    for (_, epochs), (num_of_trials, _) in zip(rungs[:level], rungs[1:level + 1]):
+        trial_ids = sorted(trial_ids, key=lambda trial_id: get_score(study["trials"][trial_id], epochs))[:num_of_trials]
+
+    return trial_ids
+
+
+def get_validation_split(rows) -> tuple:
+    # the last season is the validation set, so like in walk-forward training no later games are used for training
+    folds = get_walk_forward_folds(rows)
+    if not folds:
+        raise ValueError("the search needs features of at least two seasons")
+
+    return (get_partition_indices(rows, folds[-1]["train_partitions"]),
+            get_partition_indices(rows, folds[-1]["test_partitions"]))
+
+
+def get_checkpoint_path(trial_id: str) -> str:
+    return os.path.join(STUDY_DIR, f"trial_{trial_id}.keras")
+
+
+def train_trial(job: dict) -> dict:
+    rows = get_feature_rows()
+    train_indices, validation_indices = get_validation_split(rows)
+    threads = neural_net.worker_threads
+
+    # promoted trials continue from the weights and optimizer state they had at the end of the previous rung
+    if job["initial_epoch"]:
+        model = keras.models.load_model(get_checkpoint_path(job["trial"]))
+    else:
+        model = build_model(job["params"])
+    history = model.fit(
+        make_input_pipeline(rows, train_indices, job["params"]["batch_size"], shuffle=True, threads=threads),
+        validation_data=make_input_pipeline(rows, validation_indices, threads=threads),
+        initial_epoch=job["initial_epoch"], epochs=job["epochs"], verbose=0,
+        callbacks=[keras.callbacks.EarlyStopping(monitor="val_loss", patience=PATIENCE),
+                   keras.callbacks.TerminateOnNaN()])
+    model.save(get_checkpoint_path(job["trial"]))
+
+    val_loss = [float(loss) for loss in history.history["val_loss"]]
+    return {"trial": job["trial"], "val_loss": val_loss,
+            "stopped": job["initial_epoch"] + len(val_loss) < job["epochs"]}
+
+
+def load_study(config: dict) -> dict:
+    # a study is resumed only if it searches the same way over the same features
+    if os.path.exists(STUDY_PATH):
+        with open(STUDY_PATH) as file:
+            study = json.load(file)
+        if study["config"] == config:
+            return study
+        print("features or search settings changed, starting a new study")
+
+    return {"config": config, "trials": {}}
+
+
+def save_study(study: dict):
+    os.makedirs(STUDY_DIR, exist_ok=True)
+    with open(f"{STUDY_PATH}.tmp", "w") as file:
+        json.dump(study, file, indent=4)
+    os.replace(f"{STUDY_PATH}.tmp", STUDY_PATH)
+
+
+def get_best_params(study: dict) -> dict:
+    trial = min(study["trials"].values(), key=lambda trial: get_score(trial, len(trial["val_loss"])))
+    epochs = int(np.argmin([loss if math.isfinite(loss) else math.inf for loss in trial["val_loss"]])) + 1
+
+    return {**trial["params"], "epochs": epochs}
+
+
+def run_search(processes: int = 1, threads: int = 0, min_epochs: int = 3, max_epochs: int = 27, eta: int = 3,
+               seed: int = 0) -> dict:
+    rows = get_feature_rows()
+    data_hash = hashlib.sha256(json.dumps([hash_path(partition["path"])
+                                           for partition in rows.partitions]).encode()).hexdigest()
+    study = load_study({"min_epochs": min_epochs, "max_epochs": max_epochs, "eta": eta, "seed": seed,
+                        "search_space": SEARCH_SPACE, "data": data_hash})
+
+    brackets = get_brackets(min_epochs, max_epochs, eta)
+    bracket_trials, first_trial = [], 0
+    for bracket, rungs in enumerate(brackets):
+        trial_ids = [str(first_trial + i) for i in range(rungs[0][0])]
+        first_trial += len(trial_ids)
+        for trial_id in trial_ids:
+            study["trials"][trial_id] = study["trials"].get(trial_id) or {
+                "bracket": bracket, "params": sample_params(seed, int(trial_id)), "val_loss": [], "stopped": False}
+        bracket_trials.append(trial_ids)
+    save_study(study)
+
+    # rungs of the same level of all brackets don't depend on each other, their trials are trained together
+    with get_training_pool(processes, threads, len(study["trials"])) as pool:
+        for level in range(len(brackets[0])):
+            jobs = []
+            for rungs, trial_ids in zip(brackets, bracket_trials):
+                if level >= len(rungs):
+                    continue
+                epochs = rungs[level][1]
+                for trial_id in get_rung(study, trial_ids, rungs, level):
+                    trial = study["trials"][trial_id]
+                    # trials that stopped early or were already trained in a previous run are skipped
+                    if len(trial["val_loss"]) < epochs and not trial["stopped"]:
+                        jobs.append({"trial": trial_id, "params": trial["params"],
+                                     "initial_epoch": len(trial["val_loss"]), "epochs": epochs})
+            print(f"rung {level}: training {len(jobs)} trials")
+
+            for result in pool.imap_unordered(train_trial, jobs):
+                trial = study["trials"][result["trial"]]
+                trial["val_loss"] += result["val_loss"]
+                trial["stopped"] = result["stopped"]
+                save_study(study)
+                print(f"trial {result['trial']}: {len(trial['val_loss'])} epochs, "
+                      f"validation loss {get_score(trial, len(trial['val_loss'])):.4f}"
+                      f"{', stopped early' if result['stopped'] else ''}")
+
+    best_params = get_best_params(study)
+    with open(os.path.join(STUDY_DIR, "best_params.json"), "w") as file:
+        json.dump(best_params, file, indent=4)
+    epochs_trained = sum(len(trial["val_loss"]) for trial in study["trials"].values())
+    print(f"{len(study['trials'])} trials trained for {epochs_trained} epochs in total, best parameters: {best_params}")
+
+    return best_params
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of trials trained at the same time (0 - all cores)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="number of threads of every trial (0 - cores divided between the trials)")
+    parser.add_argument("--min-epochs", type=int, default=3, help="epochs of the first rung of the first bracket")
+    parser.add_argument("--max-epochs", type=int, default=27, help="epochs a trial is trained for at most")
+    parser.add_argument("--eta", type=int, default=3, help="only 1 / eta of the trials are promoted to the next rung")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run_search(args.processes, args.threads, args.min_epochs, args.max_epochs, args.eta, args.seed)
+
+
+if __name__ == "__main__":
+    main()
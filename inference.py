@@ -0,0 +1,61 @@
+import numpy as np
+from constants import *
+
+WEIGHTS_PATH = "data/neural_net_weights.npz"
+
+
+def linear(x: np.array) -> np.array:
+    return x
+
+
+def sigmoid(x: np.array) -> np.array:
+    # exp overflows to inf for very negative inputs, which still gives the right limit of 0
+    with np.errstate(over="ignore"):
+        return 1 / (1 + np.exp(-x))
+
+
+def relu(x: np.array) -> np.array:
+    return np.maximum(x, 0)
+
+
+def tanh(x: np.array) -> np.array:
+    return np.tanh(x)
+
+
+def softmax(x: np.array) -> np.array:
+    # subtracting the row maximum like keras does, so that exp can't overflow
+    x = np.exp(x - x.max(axis=1, keepdims=True))
+    return x / x.sum(axis=1, keepdims=True)
+
+
+ACTIVATIONS = {"linear": linear, "sigmoid": sigmoid, "relu": relu, "tanh": tanh, "softmax": softmax}
+
+
+class NumpyModel:
+    # Forward pass of the dense network trained in neural_net.py, computed in float32 like keras does,
+    # so that backtests and predictions don't have to import tensorflow.
+
+    def __init__(self, kernels: list, biases: list, activations: list):
+        self.kernels = kernels
+        self.biases = biases
+        self.activations = [ACTIVATIONS[activation] for activation in activations]
+
+    def predict(self, data: np.array, batch_size: int = 4096) -> np.array:
+        probabilities = np.empty((data.shape[0], self.kernels[-1].shape[1]), dtype=np.float32)
+        # batches keep the hidden layer activations small for big datasets
+        for start in range(0, data.shape[0], batch_size):
+            x = np.asarray(data[start:start + batch_size], dtype=np.float32)
+            for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+                x = activation(x @ kernel + bias)
+            probabilities[start:start + batch_size] = x
+
+        return probabilities
+
+
+def load_model(path: str = WEIGHTS_PATH) -> NumpyModel:
+    with np.load(path) as weights:
+        activations = weights["activations"].tolist()
+        kernels = [weights[f"kernel_{i}"] for i in range(len(activations))]
+        biases = [weights[f"bias_{i}"] for i in range(len(activations))]
+
+    return NumpyModel(kernels, biases, activations)
@@ -0,0 +1,142 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Instrumentation is off by default, then timed functions only check one flag before calling the wrapped function.
+# Timers and counters are kept per process, so work done in worker pools is only visible in the parent's totals
+# of the functions that started the pool.
+enabled = False
+log_file = None
+profiler = None
+timers = {}
+counters = {}
+lock = threading.Lock()
+
+
+def record(name: str, seconds: float):
+    with lock:
+        # calls, total seconds, longest call
+        stats = timers.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        if log_file is not None:
+            log_file.write(json.dumps({"time": time.time(), "event": name, "seconds": seconds}) + "\n")
+
+
+def count(name: str, value: int = 1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + value
+
+
+def timed(name: str):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if not enabled:
+                    return await function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    record(name, time.perf_counter() - start)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    record(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def timer(name: str):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def enable(log_path: str or None = None, profile: bool = False, trace_memory: bool = False):
+    global enabled, log_file, profiler
+    enabled = True
+    if log_path is not None:
+        # one json object per line, written as events happen so that a killed run still leaves its log
+        log_file = open(log_path, "a", buffering=1)
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+
+
+def get_report() -> dict:
+    with lock:
+        report = {
+            "timers": {name: {"calls": calls, "seconds": seconds, "max_seconds": max_seconds}
+                       for name, (calls, seconds, max_seconds) in timers.items()},
+            "counters": dict(counters)
+        }
+    if tracemalloc.is_tracing():
+        report["memory_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+
+    return report
+
+
+def print_report():
+    report = get_report()
+    print(f"{'timer':<40} {'calls':>10} {'total s':>10} {'mean ms':>10} {'max ms':>10}")
+    for name, stats in sorted(report["timers"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        print(f"{name:<40} {stats['calls']:>10} {stats['seconds']:>10.3f} "
+              f"{stats['seconds'] / stats['calls'] * 1000:>10.3f} {stats['max_seconds'] * 1000:>10.3f}")
+    for name, value in sorted(report["counters"].items()):
+        print(f"{name:<40} {value:>10}")
+
+    if tracemalloc.is_tracing():
+        print(f"peak traced memory: {report['memory_peak_mb']:.1f} MB")
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+            print(statistic)
+
+    if profiler is not None:
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(20)
+        print(stream.getvalue())
+
+    if log_file is not None:
+        log_file.write(json.dumps({"time": time.time(), "event": "summary", **report}) + "\n")
+        log_file.close()
+
+
+def add_arguments(parser):
+    parser.add_argument("--instrument", action="store_true", help="print timers and counters at the end of the run")
+    parser.add_argument("--instrument-log", help="write every timed call as a json line to this file")
+    parser.add_argument("--profile", action="store_true", help="print the cProfile statistics of the run")
+    parser.add_argument("--trace-memory", action="store_true", help="trace memory allocations with tracemalloc")
+
+
+def setup(args):
+    if args.instrument or args.instrument_log or args.profile or args.trace_memory:
+        enable(args.instrument_log, args.profile, args.trace_memory)
+        atexit.register(print_report)
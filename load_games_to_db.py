@@ -1,16 +1,13 @@
+import argparse
+import os
+import tempfile
+import time
 import pymysql
 import pandas as pd
 from constants import *
-
-
-def connect_to_db():
-    connection = pymysql.connect(host=HOST, user=USERNAME, password=PASSWORD)
-
-    if connection:
-        print('Connected!')
-        return connection
-    else:
-        raise Exception("Something went wrong...")
+import instrumentation
+from db import GAMES_COLUMNS, EVAL_COLUMNS, DATABASE, connect_to_db
+from storage import load_games
 
 
 def create_games_table(cursor):
@@ -28,30 +25,76 @@ def create_games_table(cursor):
     cursor.connection.commit()
 
 
-def insert_into_games_table(cursor, game_id, home_team_id, away_team_id, result,
-                            goal_difference, date, league_id, season):
-    insert_row_command = (
-        "INSERT IGNORE INTO games (game_id, home_team_id, away_team_id, result, goal_difference, date, league_id, "
-        "season) \n "
-        "		VALUES (%s,%s,%s,%s,%s,%s,%s,%s)")
-    row_to_insert = (game_id, home_team_id, away_team_id, result, goal_difference, date, league_id, season)
-    cursor.execute(insert_row_command, row_to_insert)
-    cursor.connection.commit()
+def get_insert_command(table: str, columns: list) -> str:
+    # pymysql turns executemany with this command into multi-row INSERT statements
+    return (f"INSERT IGNORE INTO {table} ({', '.join(columns)}) \n"
+            f"		VALUES ({','.join(['%s'] * len(columns))})")
+
+
+def insert_rows(cursor, table: str, columns: list, rows: list):
+    instrumentation.count(f"db.{table}_rows", len(rows))
+    # every batch is inserted in its own transaction
+    try:
+        cursor.executemany(get_insert_command(table, columns), rows)
+        cursor.connection.commit()
+    except pymysql.MySQLError:
+        cursor.connection.rollback()
+        raise
+
+
+@instrumentation.timed("db.insert_into_games_table")
+def insert_into_games_table(cursor, rows: list):
+    insert_rows(cursor, "games", GAMES_COLUMNS, rows)
+
+
+@instrumentation.timed("db.load_data_infile")
+def load_data_infile(cursor, table: str, columns: list, df: pd.DataFrame):
+    # the server reads the whole table from a temporary csv file in one statement,
+    # the connection has to be opened with local_infile=True
+    file = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+    try:
+        df[columns].to_csv(file, index=False, header=False, lineterminator="\n", date_format="%Y-%m-%d")
+        file.close()
+        cursor.execute(f"LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE {table} \n"
+                       f"		FIELDS TERMINATED BY ',' LINES TERMINATED BY '\\n' ({', '.join(columns)})",
+                       (file.name,))
+        cursor.connection.commit()
+    except pymysql.MySQLError:
+        cursor.connection.rollback()
+        raise
+    finally:
+        file.close()
+        os.remove(file.name)
+
+
+def bulk_load(cursor, table: str, columns: list, insert_batch, df: pd.DataFrame, batch_size: int = DB_BATCH_SIZE,
+              use_load_data: bool = False) -> int:
+    start = time.perf_counter()
+    if use_load_data:
+        load_data_infile(cursor, table, columns, df)
+    else:
+        # converting to plain python objects once, pymysql can not escape numpy types
+        rows = df[columns].astype(object).to_numpy().tolist()
+        for batch_start in range(0, len(rows), batch_size):
+            insert_batch(cursor, rows[batch_start:batch_start + batch_size])
+
+    seconds = time.perf_counter() - start
+    print(f"{table}: loaded {df.shape[0]} rows in {seconds:.2f}s ({df.shape[0] / max(seconds, 1e-9):.0f} rows/s)")
+
+    return df.shape[0]
 
 
-def append_from_df_to_games_db(cursor, df):
-    for i, row in df.iterrows():
-        insert_into_games_table(cursor, row['game_id'], row['home_team_id'], row['away_team_id'], row['result'],
-                                row['goal_difference'], row['date'], row['league_id'], row['season'])
+def append_from_df_to_games_db(cursor, df, batch_size: int = DB_BATCH_SIZE, use_load_data: bool = False):
+    return bulk_load(cursor, "games", GAMES_COLUMNS, insert_into_games_table, df, batch_size, use_load_data)
 
 
-def fill_games_db(cursor):
-    df = pd.read_pickle("data/games.pkl")
+def fill_games_db(cursor, batch_size: int = DB_BATCH_SIZE, use_load_data: bool = False):
+    df = load_games("games")
 
-    cursor.execute("USE football_prediction_db")
+    cursor.execute(f"USE {DATABASE}")
     create_games_table(cursor)
 
-    append_from_df_to_games_db(cursor, df)
+    append_from_df_to_games_db(cursor, df, batch_size, use_load_data)
 
 
 def create_eval_table(cursor):
@@ -72,43 +115,40 @@ def create_eval_table(cursor):
     cursor.connection.commit()
 
 
-def insert_into_eval_table(cursor, game_id, home_team_id, away_team_id, result, goal_difference,
-                           date, league_id, season, home_odd, draw_odd, away_odd):
-    insert_row_command = (
-        "INSERT IGNORE INTO evaluation ("
-        "game_id, home_team_id, away_team_id, result, goal_difference,"
-        "date, league_id, season, home_odd, draw_odd, away_odd) \n"
-        "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)")
-    row_to_insert = (game_id, home_team_id, away_team_id, result, goal_difference,
-                     date, league_id, season, home_odd, draw_odd, away_odd)
-    cursor.execute(insert_row_command, row_to_insert)
-    cursor.connection.commit()
+@instrumentation.timed("db.insert_into_eval_table")
+def insert_into_eval_table(cursor, rows: list):
+    insert_rows(cursor, "evaluation", EVAL_COLUMNS, rows)
 
 
-def append_from_df_to_eval_db(cursor, df):
-    for i, row in df.iterrows():
-        insert_into_eval_table(cursor, row['game_id'], row['home_team_id'], row['away_team_id'],
-                               row['result'], row['goal_difference'], row['date'], row['league_id'],
-                               row['season'], row['home_odd'], row['draw_odd'], row['away_odd'])
+def append_from_df_to_eval_db(cursor, df, batch_size: int = DB_BATCH_SIZE, use_load_data: bool = False):
+    return bulk_load(cursor, "evaluation", EVAL_COLUMNS, insert_into_eval_table, df, batch_size, use_load_data)
 
 
-def fill_eval_db(cursor):
-    df = pd.read_pickle("data/evaluation.pkl")
+def fill_eval_db(cursor, batch_size: int = DB_BATCH_SIZE, use_load_data: bool = False):
+    df = load_games("evaluation")
 
-    cursor.execute("USE football_prediction_db")
+    cursor.execute(f"USE {DATABASE}")
     create_eval_table(cursor)
 
-    append_from_df_to_eval_db(cursor, df)
+    append_from_df_to_eval_db(cursor, df, batch_size, use_load_data)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=HOST, help="database host, e.g. a local MySQL/MariaDB for testing")
+    parser.add_argument("--batch-size", type=int, default=DB_BATCH_SIZE, help="number of rows per transaction")
+    parser.add_argument("--load-data", action="store_true", help="load tables with LOAD DATA LOCAL INFILE")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(args)
+
     # connecting to database
-    connection = connect_to_db()
+    connection = connect_to_db(host=args.host, local_infile=args.load_data)
     cursor = connection.cursor()
 
     # creating tables and filling them in
-    fill_games_db(cursor)
-    fill_eval_db(cursor)
+    fill_games_db(cursor, args.batch_size, args.load_data)
+    fill_eval_db(cursor, args.batch_size, args.load_data)
 
 
 if __name__ == "__main__":
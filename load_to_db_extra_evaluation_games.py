@@ -1,17 +1,22 @@
+import argparse
+import asyncio
+import difflib
+import re
+import unicodedata
+import pymysql
 import pandas as pd
-import requests
-import json
-import time
 
+from api_client import ApiClient, ResponseCache
 from constants import *
-from load_games_to_db import append_from_df_to_eval_db, connect_to_db
+from db import GAMES_COLUMNS, EVAL_COLUMNS, get_pool, read_table
 
+TEAM_NAME_STOP_WORDS = {"fc", "cf", "afc", "sc", "ac", "as", "cd", "ud", "sd", "fk", "sk", "nk", "if", "bk", "club",
+                        "calcio", "1"}
 
-def get_games_df(connection):
-    games_df = pd.read_sql("SELECT * FROM games", connection)
 
-    # filtering out information about seasons other than 2015, 2016, 2017, 2018
-    games_df = games_df[(games_df.season >= 2015) & (games_df.season <= 2018)]
+def get_games_df():
+    # reading only 2015, 2016, 2017, 2018 seasons, the database filters out the others
+    games_df = read_table("games", seasons=(2015, 2018))
 
     return games_df
 
@@ -25,87 +30,148 @@ def get_odds_df():
     odds_df = odds_df.drop(columns=["date_created"])
 
     # converting date format to correspond to the one we use
-    odds_df.date_start = pd.to_datetime(odds_df.date_start).dt.date
+    odds_df.date_start = pd.to_datetime(pd.to_datetime(odds_df.date_start).dt.date)
 
     return odds_df
 
 
-def get_team_name_id_dict():
+async def fetch_team_name_id_dict(client: ApiClient):
     name_id_dict = {}
-    api_calls = 0  # variable that keeps track of number of API calls made (we can only make 10 per minute)
-    for league in LEAGUES1 + LEAGUES2 + LEAGUES3:
-        # extra evaluation file has only 2015, 2016, 2017, 2018 seasons
-        for season in [2015, 2016, 2017, 2018]:
-            # API call
-            url = f"{BASE_URL}/teams?league={league}&season={season}"
-            response = requests.request("GET", url, headers=HEADERS, data={})
-            parsed = json.loads(response.text)
-            api_calls += 1
-            if api_calls == 10:
-                time.sleep(61)
-                api_calls = 0
-
-            for team in parsed["response"]:
-                if team["team"]["name"] not in name_id_dict:
-                    name_id_dict[team["team"]["name"]] = team["team"]["id"]
+    # extra evaluation file has only 2015, 2016, 2017, 2018 seasons
+    responses = await asyncio.gather(*[
+        client.get("teams", {"league": league, "season": season})
+        for league in LEAGUES1 + LEAGUES2 + LEAGUES3 for season in [2015, 2016, 2017, 2018]])
+
+    # responses keep the order of the requests, so the first id we see for a name wins like before
+    for parsed in responses:
+        for team in parsed["response"]:
+            if team["team"]["name"] not in name_id_dict:
+                name_id_dict[team["team"]["name"]] = team["team"]["id"]
 
     return name_id_dict
 
 
-def get_extra_evaluation_games(games_df: pd.DataFrame, odds_df: pd.DataFrame):
-    name_id_dict = get_team_name_id_dict()
-
-    eval_df = pd.DataFrame(columns=["game_id", "home_team_id", "away_team_id", "goal_difference", "result", "date",
-                                    "league_id", "season", "home_odd", "draw_odd", "away_odd"])
-
-    for i, game in odds_df.iterrows():
-        # finding the game from odds_df in games_df and storing it in no_odds_game
-        if game.home_team_name in name_id_dict and game.away_team_name in name_id_dict:
-            no_odds_game = games_df.loc[(games_df.home_team_id == name_id_dict[game.home_team_name]) &
-                                        (games_df.away_team_id == name_id_dict[game.away_team_name]) &
-                                        (games_df.date == game.date_start)]
-            if no_odds_game.shape[0] != 0:
-                no_odds_game = no_odds_game.iloc[0]
-            else:
-                continue
-        else:
-            continue
-
-        eval_df.loc[eval_df.shape[0]] = pd.Series({
-            "game_id": no_odds_game.game_id,
-            "home_team_id": no_odds_game.home_team_id,
-            "away_team_id": no_odds_game.away_team_id,
-            "goal_difference": no_odds_game.goal_difference,
-            "result": no_odds_game.result,
-            "date": no_odds_game.date,
-            "league_id": no_odds_game.league_id,
-            "season": no_odds_game.season,
-            "home_odd": game.home_team_odd,
-            "draw_odd": game.tie_odd,
-            "away_odd": game.away_team_odd,
-        })
+async def fetch_team_names(cache: ResponseCache):
+    async with ApiClient(cache=cache) as client:
+        return await fetch_team_name_id_dict(client)
+
+
+def get_team_name_id_dict(offline: bool = False):
+    # finished seasons are cached forever, so teams are requested from the API only once
+    return asyncio.run(fetch_team_names(ResponseCache(offline=offline)))
+
+
+def normalize_team_name(name: str) -> str:
+    # dropping accents, punctuation and words like "FC" that are used inconsistently across data sources
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+    name = re.sub(r"[^a-z0-9 ]", "", re.sub(r"[-_/]", " ", name))
+    return " ".join(word for word in name.split() if word not in TEAM_NAME_STOP_WORDS)
+
+
+def map_team_names(names: pd.Series, name_id_dict: dict, fuzzy: bool = False) -> pd.Series:
+    # every distinct name is mapped once and the result is broadcast back to all rows
+    unique_names = pd.Series(names.unique())
+    team_ids = unique_names.map(name_id_dict)
+
+    if fuzzy:
+        normalized_id_dict = {}
+        for name, team_id in name_id_dict.items():
+            normalized_id_dict.setdefault(normalize_team_name(name), team_id)
+
+        unknown = team_ids.isna()
+        normalized_names = unique_names[unknown].map(normalize_team_name)
+        fuzzy_ids = normalized_names.map(normalized_id_dict)
+        # names that are still unknown are matched to the most similar known name
+        for i in fuzzy_ids.index[fuzzy_ids.isna()]:
+            closest = difflib.get_close_matches(normalized_names[i], list(normalized_id_dict), n=1, cutoff=0.85)
+            if closest:
+                fuzzy_ids[i] = normalized_id_dict[closest[0]]
+        team_ids[unknown] = fuzzy_ids
+
+    return names.map(dict(zip(unique_names, team_ids)))
+
+
+def get_extra_evaluation_games(games_df: pd.DataFrame, odds_df: pd.DataFrame, name_id_dict: dict,
+                               fuzzy: bool = False):
+    odds_df = odds_df.assign(home_team_id=map_team_names(odds_df.home_team_name, name_id_dict, fuzzy),
+                             away_team_id=map_team_names(odds_df.away_team_name, name_id_dict, fuzzy))
+    known = odds_df.home_team_id.notna() & odds_df.away_team_id.notna()
+    odds_df = odds_df[known].astype({"home_team_id": "int64", "away_team_id": "int64"})
+
+    # joining on (home_team_id, away_team_id, date) with a hash join instead of scanning games_df for every game,
+    # like before only the first game with the same teams and date is used
+    games_df = games_df.drop_duplicates(["home_team_id", "away_team_id", "date"])
+    games_df = games_df.astype({"home_team_id": "int64", "away_team_id": "int64"})
+    matched = odds_df.merge(games_df, left_on=["home_team_id", "away_team_id", "date_start"],
+                            right_on=["home_team_id", "away_team_id", "date"], how="inner")
+
+    eval_df = pd.DataFrame({
+        "game_id": matched.game_id,
+        "home_team_id": matched.home_team_id,
+        "away_team_id": matched.away_team_id,
+        "goal_difference": matched.goal_difference,
+        "result": matched.result,
+        "date": matched.date,
+        "league_id": matched.league_id,
+        "season": matched.season,
+        "home_odd": matched.home_team_odd,
+        "draw_odd": matched.tie_odd,
+        "away_odd": matched.away_team_odd,
+    })
+    print(f"{known.shape[0]} games with odds: {(~known).sum()} with unknown team names, "
+          f"{known.sum() - matched.shape[0]} not found in games, {matched.shape[0]} matched")
 
     eval_df = eval_df.drop_duplicates(ignore_index=True)
     return eval_df
 
 
+def relocate_to_evaluation(cursor, eval_df: pd.DataFrame, batch_size: int = DB_BATCH_SIZE):
+    # games are moved with a few set-based statements in one transaction,
+    # so a crash can never leave a game in both tables or in neither of them
+    games_columns = ", ".join(f"g.{column}" for column in GAMES_COLUMNS)
+    rows = eval_df[["game_id", "home_odd", "draw_odd", "away_odd"]].astype(object).to_numpy().tolist()
+    try:
+        cursor.execute("CREATE TEMPORARY TABLE extra_evaluation_games (\n"
+                       "		game_id INT NOT NULL PRIMARY KEY,\n"
+                       "		home_odd FLOAT NOT NULL,\n"
+                       "		draw_odd FLOAT NOT NULL,\n"
+                       "		away_odd FLOAT NOT NULL\n"
+                       "	)")
+        # staging ids of the games together with their odds
+        for batch_start in range(0, len(rows), batch_size):
+            cursor.executemany("INSERT IGNORE INTO extra_evaluation_games (game_id, home_odd, draw_odd, away_odd) \n"
+                               "		VALUES (%s,%s,%s,%s)", rows[batch_start:batch_start + batch_size])
+
+        cursor.execute(f"INSERT IGNORE INTO evaluation ({', '.join(EVAL_COLUMNS)}) \n"
+                       f"		SELECT {games_columns}, e.home_odd, e.draw_odd, e.away_odd \n"
+                       f"		FROM games g JOIN extra_evaluation_games e ON g.game_id = e.game_id")
+        cursor.execute("DELETE g FROM games g JOIN extra_evaluation_games e ON g.game_id = e.game_id")
+        moved = cursor.rowcount
+        cursor.connection.commit()
+    except pymysql.MySQLError:
+        cursor.connection.rollback()
+        raise
+    finally:
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS extra_evaluation_games")
+
+    print(f"moved {moved} games to the evaluation table")
+    return moved
+
+
 def main():
-    # connect to database
-    connection = connect_to_db()
-    cursor = connection.cursor()
-    cursor.execute("USE football_prediction_db")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--offline", action="store_true", help="serve all API responses from the cache")
+    parser.add_argument("--fuzzy", action="store_true", help="match team names that are spelled differently")
+    args = parser.parse_args()
 
     # get the dataframes
-    games_df = get_games_df(connection)
+    games_df = get_games_df()
     odds_df = get_odds_df()
-    eval_df = get_extra_evaluation_games(games_df, odds_df)
-
-    # delete new evaluation games from games db
-    for i, game in eval_df.iterrows():
-        cursor.execute(f"DELETE FROM games WHERE game_id = {game.game_id}")
+    eval_df = get_extra_evaluation_games(games_df, odds_df, get_team_name_id_dict(args.offline), args.fuzzy)
 
-    # load new evaluation games to db
-    append_from_df_to_eval_db(cursor, eval_df)
+    # move new evaluation games from games db to evaluation db
+    with get_pool().connection() as connection:
+        relocate_to_evaluation(connection.cursor(), eval_df)
 
 
 if __name__ == "__main__":
@@ -1,60 +1,276 @@
-import pandas as pd
+import argparse
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
 import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 from sklearn.model_selection import train_test_split
 from constants import *
+from inference import WEIGHTS_PATH
+from storage import DATA_DIR, open_features, load_features, hash_path
 
+BATCH_SIZE = 2048
+EPOCHS = 10
+# one hidden layer of 256 sigmoid units, Adam's default learning rate
+DEFAULT_PARAMS = {"units": [256], "activation": "sigmoid", "learning_rate": 0.001, "batch_size": BATCH_SIZE}
+WALK_FORWARD_DIR = "data/walk_forward"
 
-def get_numpy_dataset():
-    df = pd.read_pickle("data/neural_net.pkl")
-    df = df.drop("game_id", axis=1)
 
-    # converting dataframe to numpy array
-    dataset = df.to_numpy()
-    tmp = np.ndarray(shape=(dataset.shape[0], NUM_OF_INPUTS + NUM_OF_OUTPUTS))
-    for i, row in enumerate(dataset):
-        tmp[i] = np.array(np.concatenate((row[0], row[1])))
-    dataset = tmp
+class FeatureRows:
+    # Rows of all partitions of a feature dataset addressed by one index.
+    # The partitions stay memory-mapped and only the rows of the requested batch are copied.
 
-    return dataset
+    def __init__(self, partitions: list):
+        self.partitions = partitions
+        self.offsets = np.cumsum([0] + [partition["data"].shape[0] for partition in partitions])
 
+    def __len__(self):
+        return int(self.offsets[-1])
 
-def train_test_data_labels_split(dataset: np.array):
-    (train_dataset, test_dataset) = train_test_split(dataset, test_size=0.3)
+    def gather(self, indices: np.array):
+        # sorted indices read every partition once and in the order of the file
+        indices = np.sort(indices)
+        bounds = np.searchsorted(indices, self.offsets)
 
-    # splitting data from labels
-    train_data = np.delete(train_dataset, np.s_[NUM_OF_INPUTS:NUM_OF_INPUTS + NUM_OF_OUTPUTS], axis=1)
-    train_labels = np.delete(train_dataset, np.s_[:NUM_OF_INPUTS], axis=1)
+        data = np.empty((indices.shape[0], NUM_OF_INPUTS), dtype=np.float32)
+        labels = np.empty((indices.shape[0], NUM_OF_OUTPUTS), dtype=np.float32)
+        for partition, offset, start, end in zip(self.partitions, self.offsets, bounds[:-1], bounds[1:]):
+            if start < end:
+                positions = indices[start:end] - offset
+                data[start:end] = partition["data"][positions]
+                labels[start:end] = partition["labels"][positions]
 
-    test_data = np.delete(test_dataset, np.s_[NUM_OF_INPUTS:NUM_OF_INPUTS + NUM_OF_OUTPUTS], axis=1)
-    test_labels = np.delete(test_dataset, np.s_[:NUM_OF_INPUTS], axis=1)
+        return data, labels
 
-    return (train_data, train_labels), (test_data, test_labels)
 
+def get_feature_rows(name: str = "neural_net") -> FeatureRows:
+    return FeatureRows(open_features(name, columns=["data", "labels"]))
 
-def create_model(train_data: np.array, train_labels: np.array):
+
+def train_test_indices_split(num_of_rows: int, test_size: float = 0.3):
+    # only the indices are split, rows are read from the files when a batch needs them
+    return train_test_split(np.arange(num_of_rows), test_size=test_size)
+
+
+def make_input_pipeline(rows: FeatureRows, indices: np.array, batch_size: int = BATCH_SIZE,
+                        shuffle: bool = False, threads: int = 0) -> tf.data.Dataset:
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        # like model.fit with arrays, the order of the games changes in every epoch
+        dataset = dataset.shuffle(indices.shape[0], reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+
+    # batches are gathered in parallel and prefetched while the model trains on the previous ones
+    dataset = dataset.map(lambda batch: tf.numpy_function(rows.gather, [batch], (tf.float32, tf.float32)),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(lambda data, labels: (tf.ensure_shape(data, (None, NUM_OF_INPUTS)),
+                                                tf.ensure_shape(labels, (None, NUM_OF_OUTPUTS))))
+
+    if threads:
+        # batches are gathered by a pool of its own size instead of the shared one sized to all cores
+        options = tf.data.Options()
+        options.threading.private_threadpool_size = threads
+        dataset = dataset.with_options(options)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def build_model(params: dict = DEFAULT_PARAMS):
     # we are using softmax in the output layer to convert a vector of output values into a vector of probabilities
-    model = keras.Sequential([
-        keras.layers.Dense(NUM_OF_INPUTS),  # input layer
-        keras.layers.Dense(256, activation='sigmoid'),  # hidden layer
-        keras.layers.Dense(3, activation='softmax')  # output layer
-    ])
+    model = keras.Sequential(
+        [keras.layers.Dense(NUM_OF_INPUTS)] +  # input layer
+        [keras.layers.Dense(units, activation=params["activation"]) for units in params["units"]] +  # hidden layers
+        [keras.layers.Dense(3, activation='softmax')]  # output layer
+    )
+
+    model.compile(optimizer=keras.optimizers.Adam(params["learning_rate"]), loss='categorical_crossentropy',
+                  metrics=['accuracy'])
+
+    return model
 
-    model.compile(optimizer='Adam', loss='categorical_crossentropy', metrics=['accuracy'])
 
-    model.fit(train_data, train_labels, epochs=10, batch_size=2048)
+def create_model(train_dataset: tf.data.Dataset, params: dict = DEFAULT_PARAMS, epochs: int = EPOCHS):
+    model = build_model(params)
+    model.fit(train_dataset, epochs=epochs)
 
     return model
 
 
-def main():
-    dataset = get_numpy_dataset()
+def export_weights(model, path: str = WEIGHTS_PATH):
+    # dense layers are saved as plain arrays, so inference.py can run the model without tensorflow
+    weights = {}
+    activations = []
+    for i, layer in enumerate(model.layers):
+        kernel, bias = layer.get_weights()
+        weights[f"kernel_{i}"] = kernel.astype(np.float32)
+        weights[f"bias_{i}"] = bias.astype(np.float32)
+        activations.append(layer.get_config()["activation"])
 
-    (train_data, train_labels), (test_data, test_labels) = train_test_data_labels_split(dataset)
+    np.savez(path, activations=np.array(activations), **weights)
 
-    model = create_model(train_data, train_labels)
-    model.evaluate(test_data, test_labels)
+
+def train(params: dict = DEFAULT_PARAMS, epochs: int = EPOCHS):
+    rows = get_feature_rows()
+
+    train_indices, test_indices = train_test_indices_split(len(rows))
+
+    model = create_model(make_input_pipeline(rows, train_indices, params["batch_size"], shuffle=True), params, epochs)
+    model.evaluate(make_input_pipeline(rows, test_indices))
     model.save("neural_net")
+    export_weights(model)
+
+
+def get_walk_forward_folds(rows: FeatureRows, first_test_season: int or None = None) -> list:
+    # every fold trains on all seasons before its test season, so no future form leaks into training
+    seasons = np.array([partition["season"] for partition in rows.partitions])
+    folds = []
+    for test_season in np.unique(seasons)[1:].tolist():
+        if first_test_season is not None and test_season < first_test_season:
+            continue
+        folds.append({"season": test_season, "train_partitions": np.flatnonzero(seasons < test_season).tolist(),
+                      "test_partitions": np.flatnonzero(seasons == test_season).tolist()})
+
+    return folds
+
+
+def get_partition_indices(rows: FeatureRows, partitions: list) -> np.array:
+    return np.concatenate([np.arange(rows.offsets[i], rows.offsets[i + 1]) for i in partitions])
+
+
+def get_fold_key(fold: dict, partition_hashes: list, evaluation_hash: str) -> str:
+    # a fold is trained again only if its seasons, the evaluation set or the model changed
+    description = {
+        "train": [partition_hashes[i] for i in fold["train_partitions"]],
+        "test": [partition_hashes[i] for i in fold["test_partitions"]],
+        "evaluation": evaluation_hash,
+        "model": inspect.getsource(build_model) + inspect.getsource(create_model),
+        # folds cached before only the games of the test season were predicted are trained again
+        "evaluation_season": fold["season"],
+        "params": fold["params"],
+        "epochs": fold["epochs"]
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def get_fold_directory(season: int) -> str:
+    return os.path.join(WALK_FORWARD_DIR, f"season={season}")
+
+
+def load_fold_metrics(season: int) -> dict or None:
+    path = os.path.join(get_fold_directory(season), "metrics.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def init_training_worker(threads: int):
+    # every worker uses only its share of the cores, otherwise models trained in parallel fight over the same threads
+    global worker_threads
+    worker_threads = threads
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def get_training_pool(processes: int, threads: int, num_of_jobs: int):
+    processes = min(processes or os.cpu_count(), num_of_jobs)
+    threads = threads or max(1, os.cpu_count() // processes)
+    # workers are spawned, so they start tensorflow and BLAS with their own thread limits
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    return multiprocessing.get_context("spawn").Pool(processes, initializer=init_training_worker, initargs=(threads,))
+
+
+def train_fold(fold: dict) -> dict:
+    # the worker maps the feature files itself, only the fold description is sent to it
+    rows = get_feature_rows()
+    train_indices = get_partition_indices(rows, fold["train_partitions"])
+    test_indices = get_partition_indices(rows, fold["test_partitions"])
+
+    model = create_model(make_input_pipeline(rows, train_indices, fold["params"]["batch_size"], shuffle=True,
+                                             threads=worker_threads), fold["params"], fold["epochs"])
+    loss, accuracy = model.evaluate(make_input_pipeline(rows, test_indices, threads=worker_threads), verbose=0)
+    # the model was trained on the seasons before its test season, so it predicts only evaluation games of that season,
+    # predicting earlier games would use results that came after them
+    evaluation = load_features("neural_net_eval", columns=["game_id", "season", "data"])
+    in_season = evaluation["season"] == fold["season"]
+    probabilities = np.zeros((0, NUM_OF_OUTPUTS), dtype=np.float32)
+    if in_season.any():
+        probabilities = model.predict(evaluation["data"][in_season], batch_size=4096, verbose=0)
+
+    directory = get_fold_directory(fold["season"])
+    os.makedirs(directory, exist_ok=True)
+    export_weights(model, os.path.join(directory, "weights.npz"))
+    np.save(os.path.join(directory, "eval_probabilities.npy"), probabilities)
+    np.save(os.path.join(directory, "eval_game_ids.npy"), evaluation["game_id"][in_season])
+    metrics = {"season": fold["season"], "key": fold["key"], "train_games": int(train_indices.shape[0]),
+               "test_games": int(test_indices.shape[0]), "eval_games": int(in_season.sum()), "loss": float(loss),
+               "accuracy": float(accuracy)}
+    # metrics are written last, so a fold that was interrupted is trained again
+    with open(os.path.join(directory, "metrics.json"), "w") as file:
+        json.dump(metrics, file, indent=4)
+
+    return metrics
+
+
+def walk_forward(processes: int = 1, threads: int = 0, first_test_season: int or None = None,
+                 params: dict = DEFAULT_PARAMS, epochs: int = EPOCHS) -> list:
+    rows = get_feature_rows()
+    partition_hashes = [hash_path(partition["path"]) for partition in rows.partitions]
+    evaluation_hash = hash_path(os.path.join(DATA_DIR, "neural_net_eval"))
+
+    results, pending = {}, []
+    for fold in get_walk_forward_folds(rows, first_test_season):
+        fold["params"], fold["epochs"] = params, epochs
+        fold["key"] = get_fold_key(fold, partition_hashes, evaluation_hash)
+        metrics = load_fold_metrics(fold["season"])
+        if metrics is not None and metrics["key"] == fold["key"]:
+            results[fold["season"]] = metrics
+        else:
+            pending.append(fold)
+    print(f"{len(results)} folds are up to date, training {len(pending)} folds")
+
+    if pending:
+        with get_training_pool(processes, threads, len(pending)) as pool:
+            for metrics in pool.imap_unordered(train_fold, pending):
+                results[metrics["season"]] = metrics
+                print(f"season {metrics['season']}: accuracy {metrics['accuracy']:.4f}, loss {metrics['loss']:.4f}")
+
+    summary = [results[season] for season in sorted(results)]
+    os.makedirs(WALK_FORWARD_DIR, exist_ok=True)
+    with open(os.path.join(WALK_FORWARD_DIR, "summary.json"), "w") as file:
+        json.dump(summary, file, indent=4)
+    if summary:
+        print(f"mean accuracy over {len(summary)} folds: {np.mean([metrics['accuracy'] for metrics in summary]):.4f}")
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--walk-forward", action="store_true",
+                        help="train one model per season on all seasons before it instead of a random split")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of folds trained at the same time (0 - all cores)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="number of threads of every fold (0 - cores divided between the folds)")
+    parser.add_argument("--first-test-season", type=int, help="first season that is used as a test season")
+    parser.add_argument("--params", help="path to a json file with units, activation, learning_rate, batch_size "
+                                         "and epochs, like the best_params.json of hyperparameter_search.py")
+    args = parser.parse_args()
+
+    params, epochs = DEFAULT_PARAMS, EPOCHS
+    if args.params:
+        with open(args.params) as file:
+            params = json.load(file)
+        epochs = params.pop("epochs", EPOCHS)
+
+    if args.walk_forward:
+        walk_forward(args.processes, args.threads, args.first_test_season, params, epochs)
+    else:
+        train(params, epochs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import numpy as np
+from array import array
+from api_client import ApiClient, ResponseCache
+from api_data_extraction import stream_items, get_page_count
+from constants import *
+from storage import save_columns, load_columns
+
+ODDS_STORE_NAME = "odds_store"
+MATCH_WINNER_BET = 1
+OUTCOMES = ["Home", "Draw", "Away"]
+
+
+def parse_all_odds(body: bytes):
+    # every bookmaker's 1X2 odds of every game become one snapshot row, stamped with the time the API updated them
+    game_ids, bookmakers, updates, odds = array("i"), array("h"), [], array("f")
+    missing_values = 0
+    for game in stream_items(body, "response.item"):
+        update = game["update"][:19]
+        for bookmaker in game["bookmakers"]:
+            for bet in bookmaker["bets"]:
+                if bet["id"] != MATCH_WINNER_BET:
+                    continue
+                # outcomes are looked up by name, the ones a bookmaker didn't price are stored as NaN
+                values = {value["value"]: value["odd"] for value in bet["values"]}
+                missing_values += sum(outcome not in values for outcome in OUTCOMES)
+                game_ids.append(game["fixture"]["id"])
+                bookmakers.append(bookmaker["id"])
+                updates.append(update)
+                odds.extend(float(values.get(outcome, "nan")) for outcome in OUTCOMES)
+
+    columns = {
+        "game_id": np.asarray(game_ids),
+        "bookmaker": np.asarray(bookmakers),
+        "timestamp": np.array(updates, dtype="datetime64[s]").astype(np.int64),
+        "odds": np.asarray(odds).reshape(-1, len(OUTCOMES))
+    }
+    return columns, missing_values
+
+
+def gather(keys: np.array, values: np.array, lookup: np.array) -> np.array:
+    # rows of 'values' of the sorted 'keys' found in 'lookup', NaN for the keys that are not there
+    result = np.full((lookup.shape[0], values.shape[1]), np.nan, dtype=np.float32)
+    if keys.shape[0] == 0:
+        return result
+
+    positions = np.minimum(np.searchsorted(keys, lookup), keys.shape[0] - 1)
+    found = keys[positions] == lookup
+    result[found] = values[positions[found]]
+
+    return result
+
+
+def get_group_starts(*keys) -> np.array:
+    # positions of the sorted rows where any of the keys changes, rows of an empty array have no groups
+    starts = np.zeros(keys[0].shape[0], dtype=bool)
+    starts[:1] = True
+    for key in keys:
+        starts[1:] |= key[1:] != key[:-1]
+
+    return np.flatnonzero(starts)
+
+
+class OddsStore:
+    # Snapshots of 1X2 odds sorted by (game_id, bookmaker, timestamp).
+    # Every (game_id, bookmaker) pair is indexed by its closing line (the last snapshot),
+    # and every game by the best closing price of each outcome over all bookmakers,
+    # so lookups for many games are one binary search and one gather.
+
+    def __init__(self, columns: dict):
+        order = np.lexsort((columns["timestamp"], columns["bookmaker"], columns["game_id"]))
+        game_ids, bookmakers = columns["game_id"][order], columns["bookmaker"][order]
+        timestamps, odds = columns["timestamp"][order], columns["odds"][order]
+
+        # responses served again from the cache give the same snapshots, they are kept only once
+        snapshots = get_group_starts(game_ids, bookmakers, timestamps)
+        self.game_id, self.bookmaker = game_ids[snapshots], bookmakers[snapshots]
+        self.timestamp, self.odds = timestamps[snapshots], odds[snapshots]
+
+        pair_starts = get_group_starts(self.game_id, self.bookmaker)
+        pair_ends = np.append(pair_starts, self.game_id.shape[0])[1:]
+        self.pair_game_id = self.game_id[pair_starts]
+        self.pair_key = get_pair_keys(self.pair_game_id, self.bookmaker[pair_starts])
+        self.closing = self.odds[pair_ends - 1]
+
+        game_starts = get_group_starts(self.pair_game_id)
+        self.games = self.pair_game_id[game_starts]
+        # fmax ignores NaN, so one bookmaker's missing price doesn't hide the others
+        self.best = (np.fmax.reduceat(self.closing, game_starts, axis=0) if self.closing.shape[0]
+                     else self.closing)
+
+    def __len__(self):
+        return self.game_id.shape[0]
+
+    def get_columns(self) -> dict:
+        return {"game_id": self.game_id, "bookmaker": self.bookmaker, "timestamp": self.timestamp, "odds": self.odds}
+
+    def append(self, columns: dict):
+        return OddsStore({column: np.concatenate((values, columns[column]))
+                          for column, values in self.get_columns().items()})
+
+    def closing_odds(self, game_ids: np.array, bookmaker: int = BOOKMAKER) -> np.array:
+        return gather(self.pair_key, self.closing, get_pair_keys(game_ids, bookmaker))
+
+    def best_odds(self, game_ids: np.array) -> np.array:
+        return gather(self.games, self.best, np.asarray(game_ids))
+
+
+def get_pair_keys(game_ids: np.array, bookmakers) -> np.array:
+    # one sortable integer per (game_id, bookmaker)
+    return (np.asarray(game_ids, dtype=np.int64) << 16) | np.asarray(bookmakers, dtype=np.int64)
+
+
+def get_empty_columns() -> dict:
+    return {"game_id": np.empty(0, dtype=np.int32), "bookmaker": np.empty(0, dtype=np.int16),
+            "timestamp": np.empty(0, dtype=np.int64), "odds": np.empty((0, len(OUTCOMES)), dtype=np.float32)}
+
+
+def load_odds_store() -> OddsStore:
+    return OddsStore(load_columns(ODDS_STORE_NAME) or get_empty_columns())
+
+
+def save_odds_store(store: OddsStore):
+    save_columns(store.get_columns(), ODDS_STORE_NAME)
+
+
+async def get_league_odds(client: ApiClient, league_id: int, season: int) -> list:
+    # odds of all bookmakers, the first page tells us how many pages there are and the rest are requested together
+    params = {"league": league_id, "season": season, "bet": MATCH_WINNER_BET}
+    first_page = await client.fetch("odds", {**params, "page": 1})
+    pages = [first_page] + await asyncio.gather(*[
+        client.fetch("odds", {**params, "page": page_number})
+        for page_number in range(2, get_page_count(first_page) + 1)])
+
+    return [parse_all_odds(page) for page in pages]
+
+
+async def fetch_odds(cache: ResponseCache, leagues: list, seasons: list) -> list:
+    async with ApiClient(cache=cache) as client:
+        leagues_odds = await asyncio.gather(*[
+            get_league_odds(client, league, season) for league in leagues for season in seasons])
+
+    return [page for pages in leagues_odds for page in pages]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--offline", action="store_true", help="serve all API responses from the cache")
+    parser.add_argument("--leagues", type=int, nargs="+", default=LEAGUES1 + LEAGUES2 + LEAGUES3)
+    parser.add_argument("--seasons", type=int, nargs="+", default=[LAST_SEASON],
+                        help="API keeps odds only for recent games, so older seasons are usually empty")
+    args = parser.parse_args()
+
+    pages = asyncio.run(fetch_odds(ResponseCache(offline=args.offline), args.leagues, args.seasons))
+
+    # all pages are sorted into the store at once
+    store = load_odds_store()
+    snapshots = len(store)
+    store = store.append({column: np.concatenate([values] + [columns[column] for columns, _ in pages])
+                          for column, values in get_empty_columns().items()})
+    save_odds_store(store)
+
+    print(f"{len(store) - snapshots} new snapshots, {len(store)} snapshots of {store.pair_key.shape[0]} "
+          f"game and bookmaker pairs for {store.games.shape[0]} games, "
+          f"{sum(missing_values for _, missing_values in pages)} missing odds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+import constants
+import instrumentation
+from constants import *
+from api_client import ApiClient, ResponseCache
+from api_data_extraction import extract_all_games, save_extracted_games
+from db import connect_to_db, get_pool
+from evaluation import DEFAULT_GRID, run_evaluation
+from load_games_to_db import fill_games_db, fill_eval_db
+from load_to_db_extra_evaluation_games import (get_games_df, get_odds_df, fetch_team_name_id_dict,
+                                               get_extra_evaluation_games, relocate_to_evaluation)
+from storage import hash_path
+from transform_data import transform
+
+STATE_PATH = "data/pipeline_state.json"
+TEAM_NAMES_PATH = "data/team_name_ids.json"
+
+
+class Stage:
+    # A step of the pipeline. Its fingerprint is made of its code, the constants and parameters it uses,
+    # its input files and the outputs of the stages it depends on. The stage is skipped if the fingerprint
+    # and its output files are the same as after its last run. Stages that write only to the database
+    # have no output files, the database is trusted to still hold what they wrote, but every run of them
+    # reruns the stages that depend on them. Stages that read data which changes outside of the pipeline run always.
+
+    def __init__(self, name: str, run, dependencies: list = (), sources: list = (), constants: list = (),
+                 params: list = (), inputs: list = (), input_params: list = (), outputs: list = (),
+                 is_async: bool = False, always: bool = False):
+        self.name = name
+        self.run = run
+        self.dependencies = dependencies
+        self.sources = sources
+        self.constants = constants
+        self.params = params
+        self.inputs = inputs
+        # parameters that are paths of input files, the contents of the files are part of the fingerprint
+        self.input_params = input_params
+        self.outputs = outputs
+        self.is_async = is_async
+        self.always = always
+
+
+def get_code_fingerprint(stage: Stage) -> str:
+    description = {
+        "sources": {source: hash_path(source) for source in stage.sources},
+        # only the constants a stage uses are part of its fingerprint, so changing one reruns only its dependents
+        "constants": {constant: repr(getattr(constants, constant)) for constant in stage.constants}
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def get_fingerprint(stage: Stage, args, output_hashes: dict) -> str:
+    description = {
+        "code": get_code_fingerprint(stage),
+        "params": {param: repr(getattr(args, param)) for param in stage.params},
+        "inputs": {path: hash_path(path) for path in stage.inputs},
+        "input_params": {param: getattr(args, param) and hash_path(getattr(args, param))
+                         for param in stage.input_params},
+        "dependencies": {dependency: output_hashes[dependency] for dependency in stage.dependencies}
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def get_output_hash(stage: Stage, fingerprint: str) -> str:
+    # stages that depend on this one are rerun only if its outputs changed,
+    # a stage without output files gets a new output hash from every run, even a forced one with the same fingerprint
+    if not stage.outputs:
+        return hashlib.sha256(f"{fingerprint}:{time.time_ns()}".encode()).hexdigest()
+    return hashlib.sha256(json.dumps([hash_path(path) for path in stage.outputs]).encode()).hexdigest()
+
+
+def load_state() -> dict:
+    if not os.path.exists(STATE_PATH):
+        return {}
+    with open(STATE_PATH) as file:
+        return json.load(file)
+
+
+def save_state(state: dict):
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    with open(f"{STATE_PATH}.tmp", "w") as file:
+        json.dump(state, file, indent=4)
+    os.replace(f"{STATE_PATH}.tmp", STATE_PATH)
+
+
+async def extract_stage(context: dict):
+    save_extracted_games(*await extract_all_games(context["client"]))
+
+
+async def team_names_stage(context: dict):
+    name_id_dict = await fetch_team_name_id_dict(context["client"])
+    with open(TEAM_NAMES_PATH, "w") as file:
+        json.dump(name_id_dict, file, indent=4, sort_keys=True)
+
+
+def load_stage(context: dict):
+    args = context["args"]
+    connection = connect_to_db(host=args.host, local_infile=args.load_data)
+    try:
+        cursor = connection.cursor()
+        fill_games_db(cursor, args.batch_size, args.load_data)
+        fill_eval_db(cursor, args.batch_size, args.load_data)
+    finally:
+        connection.close()
+
+
+def relocate_stage(context: dict):
+    with open(TEAM_NAMES_PATH) as file:
+        name_id_dict = json.load(file)
+    eval_df = get_extra_evaluation_games(get_games_df(), get_odds_df(), name_id_dict, context["args"].fuzzy)
+    with get_pool().connection() as connection:
+        relocate_to_evaluation(connection.cursor(), eval_df, context["args"].batch_size)
+
+
+def transform_stage(context: dict):
+    # stored features can be reused only if they are still computed with the same code and constants,
+    # then only the games whose history changed are recomputed
+    previous = context["state"].get("transform", {})
+    incremental = previous.get("code") == get_code_fingerprint(get_stage("transform"))
+    transform(context["args"].processes, incremental)
+
+
+def train_stage(context: dict):
+    # tensorflow is imported only when the model has to be trained again
+    import neural_net
+    neural_net.train()
+
+
+def evaluate_stage(context: dict):
+    grid = DEFAULT_GRID
+    if context["args"].grid:
+        with open(context["args"].grid) as file:
+            grid = json.load(file)
+    run_evaluation(grid, context["args"].processes)
+
+
+FEATURE_CONSTANTS = ["NUM_OF_LAST_GAMES", "NUM_OF_LAST_HEAD2HEADS", "MIN_NUM_OF_LAST_GAMES",
+                     "MIN_NUM_OF_LAST_HEAD2HEADS", "MAX_DAYS_SINCE_GAME", "MAX_DAYS_SINCE_HEAD2HEAD",
+                     "NUM_OF_INPUTS", "NUM_OF_OUTPUTS"]
+STAGES = [
+    Stage("extract", extract_stage, sources=["api_data_extraction.py", "api_client.py", "storage.py"],
+          constants=["BASE_URL", "FIRST_SEASON", "LAST_SEASON", "LEAGUES1", "LEAGUES2", "LEAGUES3",
+                     "EXTRA_EVALUATION_LEAGUES", "BOOKMAKER"],
+          # new fixtures and results come from the API, the response cache keeps reruns from using up the quota
+          outputs=["data/games", "data/evaluation"], is_async=True, always=True),
+    Stage("team_names", team_names_stage, sources=["load_to_db_extra_evaluation_games.py", "api_client.py"],
+          constants=["BASE_URL", "LEAGUES1", "LEAGUES2", "LEAGUES3"], outputs=[TEAM_NAMES_PATH], is_async=True),
+    Stage("load", load_stage, dependencies=["extract"], sources=["load_games_to_db.py", "db.py"], params=["host"]),
+    Stage("relocate", relocate_stage, dependencies=["load", "team_names"],
+          sources=["load_to_db_extra_evaluation_games.py", "db.py"], params=["host", "fuzzy"],
+          inputs=["data/odds/Matches_Odds.csv"]),
+    Stage("transform", transform_stage, dependencies=["relocate"],
+          sources=["transform_data.py", "form_index.py", "feature_store.py", "storage.py", "db.py"],
+          constants=FEATURE_CONSTANTS, outputs=["data/neural_net", "data/neural_net_eval"]),
+    Stage("train", train_stage, dependencies=["transform"], sources=["neural_net.py", "storage.py"],
+          constants=["NUM_OF_INPUTS", "NUM_OF_OUTPUTS"], outputs=["neural_net", "data/neural_net_weights.npz"]),
+    Stage("evaluate", evaluate_stage, dependencies=["transform", "train"],
+          sources=["evaluation.py", "staking.py", "inference.py", "storage.py"], input_params=["grid"],
+          outputs=["data/eval_results.parquet", "data/best_params.parquet"])
+]
+
+
+def get_stage(name: str) -> Stage:
+    return next(stage for stage in STAGES if stage.name == name)
+
+
+async def run_stage(stage: Stage, tasks: dict, context: dict, state: dict, output_hashes: dict):
+    # waiting only for the stages this one depends on, so independent stages run at the same time
+    await asyncio.gather(*[tasks[dependency] for dependency in stage.dependencies])
+
+    fingerprint = get_fingerprint(stage, context["args"], output_hashes)
+    previous = state.get(stage.name, {})
+    is_valid = (previous.get("fingerprint") == fingerprint and "output_hash" in previous
+                and (not stage.outputs or previous["output_hash"] == get_output_hash(stage, fingerprint)))
+    if (is_valid and not stage.always and stage.name not in context["args"].force
+            and "all" not in context["args"].force):
+        print(f"{stage.name}: up to date, skipped")
+    else:
+        print(f"{stage.name}: running")
+        with instrumentation.timer(f"pipeline.{stage.name}"):
+            if stage.is_async:
+                await stage.run(context)
+            else:
+                # blocking stages run in threads, so they don't stop the stages that talk to the API
+                await asyncio.to_thread(stage.run, context)
+
+        state[stage.name] = {"fingerprint": fingerprint, "code": get_code_fingerprint(stage),
+                             "output_hash": get_output_hash(stage, fingerprint)}
+        save_state(state)
+
+    output_hashes[stage.name] = state[stage.name]["output_hash"]
+
+
+async def run_pipeline(args):
+    state = load_state()
+    output_hashes = {}
+    # the shared pool is created before any stage runs, so the stages that read tables through db.read_table
+    # use the --host database too and not the default one
+    get_pool(host=args.host)
+    # stages that use the API share one client, so together they stay within the limits of our API plan
+    async with ApiClient(cache=ResponseCache(offline=args.offline)) as client:
+        context = {"args": args, "client": client, "state": state}
+        tasks = {}
+        for stage in STAGES:
+            tasks[stage.name] = asyncio.create_task(run_stage(stage, tasks, context, state, output_hashes))
+        await asyncio.gather(*tasks.values())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--offline", action="store_true", help="serve all API responses from the cache")
+    parser.add_argument("--host", default=HOST, help="database host")
+    parser.add_argument("--batch-size", type=int, default=DB_BATCH_SIZE, help="number of rows per transaction")
+    parser.add_argument("--load-data", action="store_true", help="load tables with LOAD DATA LOCAL INFILE")
+    parser.add_argument("--fuzzy", action="store_true", help="match team names that are spelled differently")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes used for features and the grid search (0 - all cores)")
+    parser.add_argument("--grid", help="path to a json file with the grid of betting parameters")
+    parser.add_argument("--force", nargs="+", default=[], help="stages to run even if they are up to date, or all")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(args)
+
+    asyncio.run(run_pipeline(args))
+
+
+if __name__ == "__main__":
+    main()
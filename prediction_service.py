@@ -0,0 +1,207 @@
+import argparse
+import json
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from constants import *
+from db import read_table
+from form_index import FormIndex, to_day
+from inference import load_model
+from staking import STRATEGIES, get_predictions
+from storage import load_results
+from transform_data import get_and_merge_all_data
+
+FIXTURE_FIELDS = ["home_team_id", "away_team_id", "league_id", "date"]
+
+
+class MicroBatcher:
+    # Collects fixtures of concurrent requests for at most 'max_delay' seconds
+    # and scores them with one forward pass, so a matchday with hundreds of requests costs a few model calls.
+
+    def __init__(self, index: FormIndex, model, bet_params: dict, max_batch_size: int = SERVICE_MAX_BATCH_SIZE,
+                 max_delay: float = SERVICE_MAX_BATCH_DELAY):
+        self.index = index
+        self.model = model
+        self.bet_params = bet_params
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.pending = queue.Queue()
+        self.index_lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def predict(self, fixtures: list) -> list:
+        # fixtures are checked and featurized in the thread of their own request, so a bad fixture fails only
+        # its request and the batch is just the forward pass of valid ones
+        if not fixtures:
+            return []
+        future = Future()
+        self.pending.put((self.featurize(fixtures), future))
+        return future.result()
+
+    def add_results(self, games: list):
+        # finished games are added to the index in place, the next batch already uses them
+        with self.index_lock:
+            for game in games:
+                self.index.add_game(int(game["home_team_id"]), int(game["away_team_id"]), int(game["league_id"]),
+                                    to_day(game["date"]), int(game["goal_difference"]))
+
+    def featurize(self, fixtures: list) -> dict:
+        data = np.zeros((len(fixtures), NUM_OF_INPUTS), dtype=np.float32)
+        skipped = np.zeros(len(fixtures), dtype=bool)
+        with self.index_lock:
+            for i, fixture in enumerate(fixtures):
+                features = get_and_merge_all_data(self.index, int(fixture["home_team_id"]),
+                                                  int(fixture["away_team_id"]), int(fixture["league_id"]),
+                                                  to_day(fixture["date"]))
+                # like in transform_data, teams without enough recent games can't be predicted
+                if features is None:
+                    skipped[i] = True
+                else:
+                    data[i] = features
+
+        # fixtures can have the odds [home win, draw, away win] offered for them, strategies that need odds
+        # don't bet on fixtures without them
+        odds = np.array([fixture.get("odds", [np.nan] * NUM_OF_OUTPUTS) for fixture in fixtures],
+                        dtype=np.float64).reshape(-1, NUM_OF_OUTPUTS)
+
+        return {"fixtures": fixtures, "data": data, "skipped": skipped, "odds": odds}
+
+    def collect_batch(self) -> list:
+        batch = [self.pending.get()]
+        size = len(batch[0][0]["fixtures"])
+        deadline = time.monotonic() + self.max_delay
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0]["fixtures"])
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            try:
+                probabilities = self.model.predict(np.concatenate([request["data"] for request, _ in batch]))
+            except Exception as exception:
+                for _, future in batch:
+                    future.set_exception(exception)
+                continue
+
+            # giving every request back its own part of the batch
+            start = 0
+            for request, future in batch:
+                end = start + len(request["fixtures"])
+                try:
+                    future.set_result(self.score(request, probabilities[start:end]))
+                except Exception as exception:
+                    future.set_exception(exception)
+                start = end
+
+    def score(self, request: dict, probabilities: np.array) -> list:
+        predictions, confidence = get_predictions(probabilities)
+        strategy = STRATEGIES[self.bet_params["strategy"]]
+        outcomes, amounts, fractions = strategy.get_stakes(
+            probabilities, request["odds"],
+            np.array([[self.bet_params[param] for param in strategy.params]], dtype=np.float64))
+
+        skipped = request["skipped"]
+        return [
+            {**{field: fixture[field] for field in FIXTURE_FIELDS}, "prediction": None, "bet": 0} if skipped[i] else
+            {**{field: fixture[field] for field in FIXTURE_FIELDS}, "probabilities": probabilities[i].tolist(),
+             "prediction": int(predictions[i]), "confidence": float(confidence[i]), "bet_outcome": int(outcomes[i]),
+             "bet": float(amounts[i, 0]), "bankroll_fraction": float(fractions[i, 0])}
+            for i, fixture in enumerate(request["fixtures"])
+        ]
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # POST /predict with a list of fixtures returns probabilities [home win, draw, away win] and bets,
+    # a bet is a fixed amount and a share of the bankroll staked on bet_outcome,
+    # POST /results with a list of finished games (fixture fields and goal_difference) updates the form index
+
+    batcher = None
+
+    def send_json(self, status: int, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            games = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            # a single game can be sent without wrapping it in a list
+            if isinstance(games, dict):
+                games = [games]
+            if self.path == "/predict":
+                self.send_json(200, self.batcher.predict(games))
+            elif self.path == "/results":
+                self.batcher.add_results(games)
+                self.send_json(200, {"added": len(games)})
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+        except (ValueError, KeyError, TypeError) as exception:
+            self.send_json(400, {"error": repr(exception)})
+
+    def log_message(self, format, *args):
+        # logging every request would cost more than predicting it
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    # the default backlog of 5 connections makes clients wait for a connection retry on a busy matchday
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def get_bet_params(args) -> dict:
+    # by default we bet with the best strategy and parameters found by evaluation.py
+    best_params = load_results("eval_results").sort_values("gain", ascending=False, ignore_index=True).loc[0]
+    # results saved before there were several strategies are all of the linear one
+    strategy = STRATEGIES[best_params.get("strategy", "linear")]
+    bet_params = {"strategy": strategy.name, **{param: best_params[param] for param in strategy.params}}
+    for param in strategy.params:
+        if getattr(args, param, None) is not None:
+            bet_params[param] = getattr(args, param)
+
+    return bet_params
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    # /results changes the form index and isn't authenticated, so only local clients are served by default
+    parser.add_argument("--bind", default="127.0.0.1", help="address to listen on, 0.0.0.0 for all interfaces")
+    parser.add_argument("--min_bet_limit", type=float)
+    parser.add_argument("--max_bet_limit", type=float)
+    parser.add_argument("--min_prediction_confidence", type=float)
+    args = parser.parse_args()
+
+    # the index is built once at startup and then kept up to date through /results
+    index = FormIndex(read_table("games"))
+    PredictionHandler.batcher = MicroBatcher(index, load_model(), get_bet_params(args))
+
+    server = PredictionServer((args.bind, args.port), PredictionHandler)
+    print(f"serving predictions on {args.bind}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import numpy as np
+from constants import *
+
+
+class StakingStrategy:
+    # A way of sizing bets on the whole evaluation set at once. 'stakes' gets the probabilities and odds
+    # (home win, draw, away win) of all games and one array per parameter with its value in every combination
+    # of the grid. It returns the outcome bet on in every game, and the fixed amount and the share of the current
+    # bankroll staked on it as (games, combinations) arrays, a game isn't bet on if both are 0.
+
+    def __init__(self, name: str, stakes, params: list, default_grid: dict, uses_odds: bool = False):
+        self.name = name
+        self.stakes = stakes
+        self.params = params
+        self.default_grid = default_grid
+        # strategies that compare probabilities with the odds of all outcomes, not only the odd of the result
+        self.uses_odds = uses_odds
+
+    def get_grid(self, grid: dict) -> dict:
+        # parameters missing in the grid are searched over their default values
+        return {param: grid.get(param, self.default_grid[param]) for param in self.params}
+
+    def get_stakes(self, probabilities: np.array, odds: np.array or None, combinations: np.array) -> tuple:
+        if self.uses_odds and odds is None:
+            raise ValueError(f"{self.name} staking needs the odds of all outcomes, "
+                             f"run transform_data.py again to add them to the features")
+        return self.stakes(probabilities, odds, *combinations.T)
+
+
+def determine_bet(confidence: np.array, min_prediction_confidence: float, min_bet: int, max_bet: int) -> np.array:
+    bet_increase_per_confidence_percent = (max_bet - min_bet) / (100 - min_prediction_confidence * 100)
+
+    confidence = np.asarray(confidence, dtype=np.float64)
+    bet_increase_per_confidence_percent = np.where(
+        (0.7 <= confidence) & (confidence <= 1), bet_increase_per_confidence_percent * 1.5,
+        bet_increase_per_confidence_percent)
+
+    bet = min_bet + bet_increase_per_confidence_percent * (confidence * 100 - min_prediction_confidence * 100)
+
+    return np.where(bet < min_bet, min_bet, np.where(bet > max_bet, max_bet, bet))
+
+
+def get_predictions(probabilities: np.array) -> tuple:
+    predictions = np.argmax(probabilities, axis=1)
+    return predictions, probabilities[np.arange(probabilities.shape[0]), predictions].astype(np.float64)
+
+
+def get_best_edges(probabilities: np.array, odds: np.array) -> tuple:
+    # expected profit of one unit staked on every outcome, we bet on the outcome with the biggest one.
+    # Outcomes without odds are never bet on.
+    edges = probabilities * odds - 1
+    edges = np.where(np.isnan(edges), -np.inf, edges)
+    outcomes = np.argmax(edges, axis=1)
+    rows = np.arange(probabilities.shape[0])
+
+    return outcomes, edges[rows, outcomes], odds[rows, outcomes]
+
+
+def linear_stakes(probabilities: np.array, odds: np.array or None, min_bet_limit: np.array, max_bet_limit: np.array,
+                  min_prediction_confidence: np.array) -> tuple:
+    # bets on the predicted result grow with the confidence from min_bet_limit to max_bet_limit
+    predictions, confidence = get_predictions(probabilities)
+    confidence = confidence[:, None]
+    amounts = np.where(confidence >= min_prediction_confidence,
+                       determine_bet(confidence, min_prediction_confidence, min_bet_limit, max_bet_limit), 0)
+
+    return predictions, amounts, np.zeros_like(amounts)
+
+
+def flat_stakes(probabilities: np.array, odds: np.array or None, bet_size: np.array,
+                min_prediction_confidence: np.array) -> tuple:
+    # the same bet on every predicted result we are confident enough about
+    predictions, confidence = get_predictions(probabilities)
+    amounts = np.where(confidence[:, None] >= min_prediction_confidence, bet_size, 0.0)
+
+    return predictions, amounts, np.zeros_like(amounts)
+
+
+def kelly_stakes(probabilities: np.array, odds: np.array, kelly_fraction: np.array, min_edge: np.array) -> tuple:
+    # Kelly criterion: the share of the bankroll that maximizes its expected logarithm is edge / (odd - 1),
+    # fractional Kelly stakes only a part of it, which lowers the variance when the probabilities are overconfident
+    outcomes, edges, outcome_odds = get_best_edges(probabilities, odds)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        full_kelly = (edges / (outcome_odds - 1))[:, None]
+    fractions = np.where((edges[:, None] > min_edge) & (full_kelly > 0), kelly_fraction * full_kelly, 0)
+
+    return outcomes, np.zeros_like(fractions), fractions
+
+
+def value_stakes(probabilities: np.array, odds: np.array, bet_size: np.array, min_edge: np.array) -> tuple:
+    # the same bet on every outcome whose probability times its odd is bigger than 1 + min_edge
+    outcomes, edges, _ = get_best_edges(probabilities, odds)
+    amounts = np.where(edges[:, None] > min_edge, bet_size, 0.0)
+
+    return outcomes, amounts, np.zeros_like(amounts)
+
+
+STRATEGIES = {strategy.name: strategy for strategy in [
+    # min_bet_limit: min amount of money we can bet on a game
+    # max_bet_limit: max amount of money we can bet on a game
+    # min_prediction_confidence: min probability of the result that we are going to bet on
+    StakingStrategy("linear", linear_stakes, ["min_bet_limit", "max_bet_limit", "min_prediction_confidence"], {
+        "min_bet_limit": [10, 20, 50, 75],
+        "max_bet_limit": [50, 100, 200, 500],
+        "min_prediction_confidence": [0.4, 0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8]
+    }),
+    StakingStrategy("flat", flat_stakes, ["bet_size", "min_prediction_confidence"], {
+        "bet_size": [10, 20, 50, 100],
+        "min_prediction_confidence": [0.4, 0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8]
+    }),
+    # kelly_fraction: share of the Kelly stake we bet
+    # min_edge: min expected profit of one unit staked on the outcome we are going to bet on
+    StakingStrategy("kelly", kelly_stakes, ["kelly_fraction", "min_edge"], {
+        "kelly_fraction": [1.0],
+        "min_edge": [0, 0.02, 0.05, 0.1, 0.2]
+    }, uses_odds=True),
+    StakingStrategy("fractional_kelly", kelly_stakes, ["kelly_fraction", "min_edge"], {
+        "kelly_fraction": [0.1, 0.25, 0.5],
+        "min_edge": [0, 0.02, 0.05, 0.1, 0.2]
+    }, uses_odds=True),
+    StakingStrategy("value", value_stakes, ["bet_size", "min_edge"], {
+        "bet_size": [10, 20, 50, 100],
+        "min_edge": [0, 0.02, 0.05, 0.1, 0.2]
+    }, uses_odds=True)
+]}
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from constants import *
+
+DATA_DIR = "data"
+PARTITIONING = ds.partitioning(pa.schema([("league_id", pa.int32()), ("season", pa.int32())]), flavor="hive")
+# feature datasets have fixed-width columns, so their matrices can be read without unpacking rows
+FEATURE_SCHEMA = pa.schema([
+    # row of the game in the saved dataset, partitions don't keep the order of the games
+    ("position", pa.int64()),
+    ("game_id", pa.int32()),
+    ("date", pa.date32()),
+    ("data", pa.list_(pa.float32(), NUM_OF_INPUTS)),
+    ("labels", pa.list_(pa.float32(), NUM_OF_OUTPUTS)),
+    ("result_odd", pa.float64()),
+    ("odds", pa.list_(pa.float64(), NUM_OF_OUTPUTS))
+])
+
+
+def get_partition_filter(leagues: list or None, seasons: tuple or None):
+    # seasons is a (first, last) range like in db.read_table
+    conditions = []
+    if leagues is not None:
+        conditions.append(ds.field("league_id").isin(leagues))
+    if seasons is not None:
+        conditions.append((ds.field("season") >= seasons[0]) & (ds.field("season") <= seasons[1]))
+
+    condition = None
+    for other_condition in conditions:
+        condition = other_condition if condition is None else condition & other_condition
+    return condition
+
+
+def save_games(df: pd.DataFrame, name: str):
+    # games tables are stored as parquet files partitioned by league and season
+    path = os.path.join(DATA_DIR, name)
+    shutil.rmtree(path, ignore_errors=True)
+    table = pa.Table.from_pandas(df.astype({"league_id": "int32", "season": "int32"}), preserve_index=False)
+    ds.write_dataset(table, path, format="parquet", partitioning=PARTITIONING,
+                     basename_template="part-{i}.parquet")
+
+
+def load_games(name: str, columns: list or None = None, leagues: list or None = None,
+               seasons: tuple or None = None) -> pd.DataFrame:
+    # only the files of the requested partitions and the requested columns are read
+    dataset = ds.dataset(os.path.join(DATA_DIR, name), format="parquet", partitioning=PARTITIONING)
+    df = dataset.to_table(columns=columns, filter=get_partition_filter(leagues, seasons)).to_pandas()
+    # parquet has no seconds resolution, dates are read back in the type that db.read_table uses
+    if "date" in df.columns:
+        df["date"] = df["date"].astype("datetime64[s]")
+
+    return df
+
+
+def get_feature_partitions(name: str, leagues: list or None = None, seasons: tuple or None = None) -> list:
+    partitions = []
+    root = os.path.join(DATA_DIR, name)
+    for league_directory in sorted(os.listdir(root)):
+        league_id = int(league_directory.split("=")[1])
+        if leagues is not None and league_id not in leagues:
+            continue
+        for season_directory in sorted(os.listdir(os.path.join(root, league_directory))):
+            season = int(season_directory.split("=")[1])
+            if seasons is not None and not seasons[0] <= season <= seasons[1]:
+                continue
+            partitions.append((league_id, season, os.path.join(root, league_directory, season_directory, "part-0.arrow")))
+
+    return partitions
+
+
+def save_features(dataset: dict, name: str):
+    # every partition is an uncompressed arrow file, so readers can memory-map it instead of loading it
+    path = os.path.join(DATA_DIR, name)
+    shutil.rmtree(path, ignore_errors=True)
+
+    partitions = pd.DataFrame({"league_id": dataset["league_id"], "season": dataset["season"]})
+    for (league_id, season), positions in partitions.groupby(["league_id", "season"]).indices.items():
+        columns = {
+            "position": pa.array(positions.astype(np.int64)),
+            "game_id": pa.array(dataset["game_id"][positions].astype(np.int32)),
+            "date": pa.array(dataset["date"][positions].astype("datetime64[D]")),
+            "data": pa.FixedSizeListArray.from_arrays(dataset["data"][positions].astype(np.float32).ravel(),
+                                                      NUM_OF_INPUTS),
+            "labels": pa.FixedSizeListArray.from_arrays(dataset["labels"][positions].astype(np.float32).ravel(),
+                                                        NUM_OF_OUTPUTS)
+        }
+        if "result_odd" in dataset:
+            columns["result_odd"] = pa.array(dataset["result_odd"][positions].astype(np.float64))
+        if "odds" in dataset:
+            columns["odds"] = pa.FixedSizeListArray.from_arrays(dataset["odds"][positions].astype(np.float64).ravel(),
+                                                                NUM_OF_OUTPUTS)
+        table = pa.table(columns, schema=pa.schema([FEATURE_SCHEMA.field(column) for column in columns]))
+
+        partition_path = os.path.join(path, f"league_id={league_id}", f"season={season}")
+        os.makedirs(partition_path)
+        with pa.OSFile(os.path.join(partition_path, "part-0.arrow"), "wb") as file:
+            with pa.ipc.new_file(file, table.schema) as writer:
+                writer.write_table(table)
+
+
+def read_feature_partition(path: str, columns: list or None = None) -> pa.Table:
+    # the table is backed by the memory-mapped file, its pages are read only when they are used
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return table if columns is None else table.select([column for column in columns if column in table.schema.names])
+
+
+def column_to_numpy(column: pa.ChunkedArray) -> np.array:
+    # fixed size lists are flat buffers, so every chunk becomes a 2-D view without copying
+    chunks = []
+    for chunk in column.chunks:
+        if pa.types.is_fixed_size_list(chunk.type):
+            chunks.append(chunk.flatten().to_numpy().reshape(-1, chunk.type.list_size))
+        elif pa.types.is_date(chunk.type):
+            chunks.append(chunk.to_numpy(zero_copy_only=False).astype("datetime64[D]"))
+        else:
+            chunks.append(chunk.to_numpy())
+
+    return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+
+def load_features(name: str, columns: list or None = None, leagues: list or None = None,
+                  seasons: tuple or None = None) -> dict:
+    tables = []
+    for league_id, season, path in get_feature_partitions(name, leagues, seasons):
+        table = read_feature_partition(path, None if columns is None else columns + ["position"])
+        tables.append(table.append_column("league_id", pa.array(np.full(table.num_rows, league_id, np.int32)))
+                      .append_column("season", pa.array(np.full(table.num_rows, season, np.int32))))
+
+    # partitions are read in the order of their directories, the games are put back in the order they were saved in
+    table = pa.concat_tables(tables)
+    if "position" not in table.schema.names:
+        raise ValueError(f"{name} was saved without the order of its games, run transform_data.py again")
+    order = np.argsort(column_to_numpy(table.column("position")), kind="stable")
+    return {column: column_to_numpy(table.column(column))[order] for column in table.schema.names
+            if column != "position" and (columns is None or column in columns)}
+
+
+def save_results(df: pd.DataFrame, name: str):
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(DATA_DIR, f"{name}.parquet"))
+
+
+def load_results(name: str) -> pd.DataFrame:
+    return pq.read_table(os.path.join(DATA_DIR, f"{name}.parquet"), memory_map=True).to_pandas()
+
+
+def open_features(name: str, columns: list or None = None, leagues: list or None = None,
+                  seasons: tuple or None = None) -> list:
+    # unlike load_features the partitions are not concatenated,
+    # so every array stays a view of its memory-mapped file and is read from disk only when it is used
+    partitions = []
+    for league_id, season, path in get_feature_partitions(name, leagues, seasons):
+        table = read_feature_partition(path, columns)
+        partitions.append({"league_id": league_id, "season": season, "path": path,
+                           **{column: column_to_numpy(table.column(column)) for column in table.schema.names}})
+
+    return partitions
+
+
+def save_columns(columns: dict, name: str):
+    # one memory-mappable arrow file, 2-D arrays are stored as fixed size lists like the features
+    table = pa.table({column: pa.FixedSizeListArray.from_arrays(values.ravel(), values.shape[1])
+                      if values.ndim == 2 else pa.array(values) for column, values in columns.items()})
+    path = os.path.join(DATA_DIR, f"{name}.arrow")
+    with pa.OSFile(f"{path}.tmp", "wb") as file:
+        with pa.ipc.new_file(file, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_columns(name: str) -> dict or None:
+    path = os.path.join(DATA_DIR, f"{name}.arrow")
+    if not os.path.exists(path):
+        return None
+
+    table = read_feature_partition(path)
+    return {column: column_to_numpy(table.column(column)) for column in table.schema.names}
+
+
+def hash_path(path: str) -> str:
+    # hash of a file, or of all files of a directory together with their relative paths
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for directory, directories, files in sorted(os.walk(path)):
+            directories.sort()
+            for file in sorted(files):
+                file_path = os.path.join(directory, file)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(hash_path(file_path).encode())
+    elif os.path.exists(path):
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(2 ** 20), b""):
+                digest.update(block)
+    else:
+        return "missing"
+
+    return digest.hexdigest()
@@ -1,32 +1,35 @@
+import argparse
+import multiprocessing
+import os
 import pandas as pd
 import numpy as np
-import pymysql
-from datetime import datetime
 from constants import *
+import instrumentation
+from db import read_table
+from feature_store import (get_sources, load_store, save_store, load_watermark, save_watermark, get_changed_games,
+                           count_late_games, get_invalidated_games)
+from form_index import FormIndex, to_days
+from storage import save_features
 
 
-def days_from_to(from_date: datetime, to_date: datetime) -> int:
-    return (to_date - from_date).days
+def get_result_odds(df: pd.DataFrame) -> np.array:
+    # returning the odd of the actual result of every game
+    results = df["result"].to_numpy()
+    return np.select([results == 1, results == 0], [df["home_odd"].to_numpy(dtype=np.float64),
+                                                    df["draw_odd"].to_numpy(dtype=np.float64)],
+                     df["away_odd"].to_numpy(dtype=np.float64))
 
 
-def get_odd_name(result: int) -> str:
-    # returning odd name based on the result
-    if result == 1:
-        return "home_odd"
-    elif result == 0:
-        return "draw_odd"
-    else:
-        return "away_odd"
+def get_odds(df: pd.DataFrame) -> np.array:
+    # returning odds of all outcomes in the order of the labels: home win, draw, away win
+    return df[["home_odd", "draw_odd", "away_odd"]].to_numpy(dtype=np.float64)
 
 
-def get_label(res: int) -> np.array:
-    # returning label based on the result
-    if res == 1:
-        return np.array([1, 0, 0])
-    elif res == 0:
-        return np.array([0, 1, 0])
-    else:
-        return np.array([0, 0, 1])
+def get_labels(results: np.array) -> np.array:
+    # returning one-hot labels based on the results: [1, 0, 0] - home win, [0, 1, 0] - draw, [0, 0, 1] - away win
+    labels = np.zeros((len(results), NUM_OF_OUTPUTS), dtype=np.float32)
+    labels[np.arange(len(results)), np.select([results == 1, results == 0], [0, 1], 2)] = 1
+    return labels
 
 
 def check_games_results(games_results: list, minimum: int, maximum: int) -> list:
@@ -50,137 +53,202 @@ def check_games_results(games_results: list, minimum: int, maximum: int) -> list
     return games_results
 
 
-def n_last_team_games(df: pd.DataFrame, team_id: int, league_id: int, n: int, prediction_game_date: datetime):
-    games_results = []
-    # filtering out not relevant information
-    df0 = df.loc[(df['league_id'] == league_id) & ((df['home_team_id'] == team_id) | (df['away_team_id'] == team_id))]
-    # we iterate in reverse order so that we include the latest games
-    for i in range(df0.shape[0] - 1, -1, -1):
-        game = df0.iloc[i]
-        # we don't want to include games that did not happen yet when this game took place,
-        # and also we don't want to use the games that happened more than 'MAX_DAYS_SINCE_GAME' days ago,
-        # this can happen because a team can leave a league for a few seasons and then come back,
-        # but we don't want to use the results from years ago since they are not relevant anymore
-        if 0 < days_from_to(game["date"], prediction_game_date) < MAX_DAYS_SINCE_GAME:
-            if game["home_team_id"] == team_id:
-                games_results.append(game["goal_difference"])
-            elif game["away_team_id"] == team_id:
-                games_results.append(game["goal_difference"] * -1)
-
-            if len(games_results) == n:
-                break
+@instrumentation.timed("features.n_last_team_games")
+def n_last_team_games(index: FormIndex, team_id: int, league_id: int, n: int, prediction_game_day: int):
+    # we don't want to include games that did not happen yet when this game took place,
+    # and also we don't want to use the games that happened more than 'MAX_DAYS_SINCE_GAME' days ago,
+    # this can happen because a team can leave a league for a few seasons and then come back,
+    # but we don't want to use the results from years ago since they are not relevant anymore
+    games_results = index.last_team_results(team_id, league_id, n, prediction_game_day, MAX_DAYS_SINCE_GAME)
 
     games_results = check_games_results(games_results, MIN_NUM_OF_LAST_GAMES, NUM_OF_LAST_GAMES)
 
     return games_results
 
 
-def n_last_head2head(df: pd.DataFrame, home_team_id: int, away_team_id: int, n: int, prediction_game_date: datetime):
-    games_results = []
-    # filtering out not relevant information
-    df0 = df.loc[((df['home_team_id'] == home_team_id) & (df['away_team_id'] == away_team_id)) |
-                 ((df['home_team_id'] == away_team_id) & (df['away_team_id'] == home_team_id))]
-    # we iterate in reverse order so that we include the latest games
-    for i in range(df0.shape[0] - 1, -1, -1):
-        game = df0.iloc[i]
-        # we don't want to include games that did not happen when this game took place,
-        # and also we don't want to use the games that happened more than 'MAX_DAYS_SINCE_HEAD2HEAD' days ago,
-        # this can happen because a team can leave a league for a few seasons and then come back,
-        # but we don't want to use the results from years ago since they are not relevant anymore
-        if 0 < days_from_to(game["date"], prediction_game_date) < MAX_DAYS_SINCE_HEAD2HEAD:
-            if game["home_team_id"] == home_team_id:
-                games_results.append(game["goal_difference"])
-            else:
-                games_results.append(game["goal_difference"] * -1)
-
-        if len(games_results) == n:
-            return games_results
+@instrumentation.timed("features.n_last_head2head")
+def n_last_head2head(index: FormIndex, home_team_id: int, away_team_id: int, n: int, prediction_game_day: int):
+    # we don't want to include games that did not happen when this game took place,
+    # and also we don't want to use the games that happened more than 'MAX_DAYS_SINCE_HEAD2HEAD' days ago
+    games_results = index.last_head2head_results(
+        home_team_id, away_team_id, n, prediction_game_day, MAX_DAYS_SINCE_HEAD2HEAD)
 
     games_results = check_games_results(games_results, MIN_NUM_OF_LAST_HEAD2HEADS, NUM_OF_LAST_HEAD2HEADS)
 
     return games_results
 
 
-def get_and_merge_all_data(df: pd.DataFrame, row: pd.Series):
-    head2head = n_last_head2head(
-        df, row.loc["home_team_id"], row.loc["away_team_id"], NUM_OF_LAST_HEAD2HEADS, row.loc["date"])
+def get_and_merge_all_data(index: FormIndex, home_team_id: int, away_team_id: int, league_id: int,
+                           prediction_game_day: int):
+    head2head = n_last_head2head(index, home_team_id, away_team_id, NUM_OF_LAST_HEAD2HEADS, prediction_game_day)
     if head2head is None:
         return None
 
     last_results_home_team = n_last_team_games(
-        df, row.loc["home_team_id"], row.loc["league_id"], NUM_OF_LAST_GAMES, row.loc["date"])
+        index, home_team_id, league_id, NUM_OF_LAST_GAMES, prediction_game_day)
     if last_results_home_team is None:
         return None
 
     last_results_away_team = n_last_team_games(
-        df, row.loc["away_team_id"], row.loc["league_id"], NUM_OF_LAST_GAMES, row.loc["date"])
+        index, away_team_id, league_id, NUM_OF_LAST_GAMES, prediction_game_day)
     if last_results_away_team is None:
         return None
 
-    # merging all data in a numpy array
-    data = np.array(head2head + last_results_home_team + last_results_away_team)
+    # merging all data in one list
+    return head2head + last_results_home_team + last_results_away_team
+
 
-    return data
+def build_feature_matrix(index: FormIndex, df: pd.DataFrame):
+    # filling in preallocated arrays instead of appending rows to a DataFrame
+    data = np.zeros((df.shape[0], NUM_OF_INPUTS), dtype=np.float32)
+    skipped = np.zeros(df.shape[0], dtype=bool)
 
+    games = zip(df["home_team_id"].tolist(), df["away_team_id"].tolist(), df["league_id"].tolist(),
+                to_days(df["date"]).tolist())
+    for i, (home_team_id, away_team_id, league_id, day) in enumerate(games):
+        features = get_and_merge_all_data(index, home_team_id, away_team_id, league_id, day)
+        # features can be None if we don't have enough data to fill in some components (head2heads, last_n_games, etc)
+        if features is None:
+            skipped[i] = True
+            instrumentation.count("features.skipped_games")
+        else:
+            data[i] = features
 
-def get_training_testing_df(games_df: pd.DataFrame):
-    neural_net_df = pd.DataFrame(columns=["game_id", "data", "label"])
-    for i, row in games_df.iterrows():
-        data = get_and_merge_all_data(games_df, row)
-        # data can be None if we don't have enough data to fill in some components (head2heads, last_n_games, etc)
-        if data is None:
-            continue
+    labels = get_labels(df["result"].to_numpy())
 
-        neural_net_df.loc[neural_net_df.shape[0]] = pd.Series({
-            "game_id": row.game_id,
-            "data": data,
-            "label": get_label(row.loc["result"])
-        })
+    return data, labels, skipped
 
-    return neural_net_df
 
+def init_worker(index: FormIndex):
+    # every worker process receives the read-only index once instead of with every shard
+    global worker_index
+    worker_index = index
 
-def get_evaluation_df(games_df: pd.DataFrame, eval_df: pd.DataFrame):
-    neural_net_eval_df = pd.DataFrame(columns=["game_id", "data", "label", "result_odd"])
-    for i, row in eval_df.iterrows():
-        data = get_and_merge_all_data(games_df, row)
-        # data can be None if we don't have enough data to fill in some components (head2heads, last_n_games, etc)
-        if data is None:
-            continue
 
-        neural_net_eval_df.loc[len(neural_net_eval_df.index)] = pd.Series({
-            "game_id": row["game_id"],
-            "data": data,
-            "label": get_label(row.loc["result"]),
-            "result_odd": np.float64(row.loc[get_odd_name(row.loc["result"])])
-        })
+def build_shard_feature_matrix(shard: pd.DataFrame):
+    return build_feature_matrix(worker_index, shard)
 
-    return neural_net_eval_df
 
+def build_feature_matrix_parallel(index: FormIndex, df: pd.DataFrame, processes: int):
+    # team form never crosses league boundaries and head2heads are looked up in the shared index,
+    # so every (league, season) can be processed independently
+    shards = sorted(df.groupby(["league_id", "season"]).indices.values(), key=len, reverse=True)
+    columns = ["home_team_id", "away_team_id", "league_id", "date", "result"]
 
-def connect_to_db():
-    connection = pymysql.connect(host=HOST, user=USERNAME, password=PASSWORD)
+    data = np.zeros((df.shape[0], NUM_OF_INPUTS), dtype=np.float32)
+    labels = np.zeros((df.shape[0], NUM_OF_OUTPUTS), dtype=np.float32)
+    skipped = np.zeros(df.shape[0], dtype=bool)
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(index,)) as pool:
+        shard_results = pool.imap(build_shard_feature_matrix, (df[columns].iloc[positions] for positions in shards))
+        # putting the rows of every shard back to their original positions
+        for positions, (shard_data, shard_labels, shard_skipped) in zip(shards, shard_results):
+            data[positions] = shard_data
+            labels[positions] = shard_labels
+            skipped[positions] = shard_skipped
 
-    if connection:
-        print('Connected!')
-        return connection
-    else:
-        raise Exception("Something went wrong...")
+    return data, labels, skipped
+
+
+@instrumentation.timed("features.build_features")
+def build_features(index: FormIndex, df: pd.DataFrame, processes: int = 1):
+    if processes == 1:
+        return build_feature_matrix(index, df)
+    return build_feature_matrix_parallel(index, df, processes or os.cpu_count())
+
+
+def update_feature_store(index: FormIndex, df: pd.DataFrame, name: str, dirty_games: pd.DataFrame,
+                         incremental: bool, processes: int = 1) -> dict:
+    sources = get_sources(df)
+    store = load_store(name) if incremental else None
+
+    # we recompute new and changed games, and games whose last games or head2heads include a dirty game
+    changed, _ = get_changed_games(store, sources)
+    recompute = changed if store is None else changed | get_invalidated_games(sources, dirty_games)
+    print(f"{name}: computing features for {recompute.sum()} of {df.shape[0]} games")
+
+    new_store = {column: sources[column].to_numpy() for column in sources.columns}
+    new_store["data"] = np.zeros((df.shape[0], NUM_OF_INPUTS), dtype=np.float32)
+    new_store["skipped"] = np.zeros(df.shape[0], dtype=bool)
+    if store is not None:
+        # reusing features of the games that are still valid
+        stored_positions = pd.Index(store["game_id"]).get_indexer(sources["game_id"][~recompute])
+        new_store["data"][~recompute] = store["data"][stored_positions]
+        new_store["skipped"][~recompute] = store["skipped"][stored_positions]
+
+    if recompute.any():
+        data, _, skipped = build_features(index, df.iloc[np.flatnonzero(recompute)], processes)
+        new_store["data"][recompute] = data
+        new_store["skipped"][recompute] = skipped
+
+    save_store(name, new_store)
+
+    return new_store
+
+
+def get_training_testing_dataset(games_df: pd.DataFrame, store: dict) -> dict:
+    skipped = store["skipped"]
+
+    return {
+        "game_id": games_df["game_id"].to_numpy()[~skipped],
+        "date": games_df["date"].to_numpy()[~skipped],
+        "league_id": games_df["league_id"].to_numpy()[~skipped],
+        "season": games_df["season"].to_numpy()[~skipped],
+        "data": store["data"][~skipped],
+        "labels": get_labels(games_df["result"].to_numpy())[~skipped]
+    }
+
+
+def get_evaluation_dataset(eval_df: pd.DataFrame, store: dict) -> dict:
+    skipped = store["skipped"]
+
+    return {
+        "game_id": eval_df["game_id"].to_numpy()[~skipped],
+        "date": eval_df["date"].to_numpy()[~skipped],
+        "league_id": eval_df["league_id"].to_numpy()[~skipped],
+        "season": eval_df["season"].to_numpy()[~skipped],
+        "data": store["data"][~skipped],
+        "labels": get_labels(eval_df["result"].to_numpy())[~skipped],
+        "result_odd": get_result_odds(eval_df)[~skipped],
+        "odds": get_odds(eval_df)[~skipped]
+    }
+
+
+def transform(processes: int = 1, incremental: bool = False):
+    games_df = read_table("games")
+    eval_df = read_table("evaluation")
+
+    # indexing the history of games once instead of scanning games_df for every feature
+    index = FormIndex(games_df)
+
+    # games that were added, corrected or removed since the last run change the history the features are built from
+    games_sources = get_sources(games_df)
+    changed, previous = get_changed_games(load_store("games") if incremental else None, games_sources)
+    watermark = load_watermark() if incremental else {}
+    print(f"{changed.sum()} new or changed games, "
+          f"{count_late_games(games_sources, changed, watermark)} of them not after the watermark, "
+          f"{previous.shape[0]} changed or removed stored games")
+    dirty_games = pd.concat([games_sources[changed], previous], ignore_index=True)
+
+    games_store = update_feature_store(index, games_df, "games", dirty_games, incremental, processes)
+    eval_store = update_feature_store(index, eval_df, "evaluation", dirty_games, incremental, processes)
+    save_watermark(games_sources)
+
+    # Getting datasets for neural network
+    save_features(get_training_testing_dataset(games_df, games_store), "neural_net")
+    save_features(get_evaluation_dataset(eval_df, eval_store), "neural_net_eval")
 
 
 def main():
-    connection = connect_to_db()
-    cursor = connection.cursor()
-    cursor.execute("USE football_prediction_db")
-
-    games_df = pd.read_sql("SELECT * FROM games", connection)
-    eval_df = pd.read_sql("SELECT * FROM evaluation", connection)
-
-    # Getting dfs for neural network
-    neural_net_df = get_training_testing_df(games_df)
-    neural_net_df.to_pickle("data/neural_net.pkl")
-    neural_net_eval_df = get_evaluation_df(games_df, eval_df)
-    neural_net_eval_df.to_pickle("data/neural_net_eval.pkl")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes used to build the features (0 - all cores)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="compute features only for new games and games affected by changed results")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(args)
+
+    transform(args.processes, args.incremental)
 
 
 if __name__ == "__main__":